@@ -16,9 +16,14 @@
 # ----------------------------------------------------------------------------------------------------------------- #
 
 from class_RAW_NeuronalData import *
+import hashlib
+import json
 from pathlib import Path
 import os.path
 import pandas as pd
+import shutil
+
+DETECTION_CACHE_VERSION = 1  # Bump when the detection itself changes, so cached spike data is recomputed #
 
 # ----------------------------------------------------------------------------------------------------------------- #
 
@@ -27,49 +32,219 @@ import pandas as pd
 # ----------------------------------------------------------------------------------------------------------------- #
 
 
-def defective_electrode_removal(DIV, defective_electrodes, MEA, SPKS):
+def defective_channels(DIV, defective_electrodes, MEA):
+
+    """ Looks up the defective electrodes of a MEA in the defective_electrodes table, so they can be excluded when the
+    recordings are loaded
+
+              Arguments:
+
+                  DIV(str): Days in vitro of the recording
+                  defective_electrodes(dict): Table of defective electrodes per DIV, density and MEA
+                  MEA(str): Number of the MEA recorded
+
+            Returns:
+
+               List of defective electrode numbers
+
+              """
 
-    for density in defective_electrodes[DIV]:
+    channels = list()
+
+    for density in defective_electrodes.get(DIV, {}):
 
         for culture in defective_electrodes[DIV][density]:
 
             if culture == MEA:
 
-                SPKS.exclusion(defective_electrodes[DIV][density][culture])
+                channels.extend(defective_electrodes[DIV][density][culture])
+
+    return channels
 
 
-def folderwide_recursive_spike_detection(MEAs_paths):
+def defective_electrode_removal(DIV, defective_electrodes, MEA, SPKS):
+
+    SPKS.exclusion(defective_channels(DIV=DIV, defective_electrodes=defective_electrodes, MEA=MEA))
+
+
+def folderwide_recursive_spike_detection(MEAs_paths, cache_path=None, filter_chain=None, estimator='std'):
 
     """ Reads a dictionary with paths to electrophysiological recordings from multielectrode arrays exported with the
-    MCD_files_export_uV_and_mS_plus_METADATA.m script as *.mat files and runs further analysis
+    MCD_files_export_uV_and_mS_plus_METADATA.m script as *.mat files and runs further analysis. With a cache, MEAs whose
+    .mat files and detection parameters are unchanged since an earlier run are not detected again.
 
               Arguments:
 
                   MEAs_paths(dict): Dictionary with paths to the recordings
+                  cache_path(str): Folder of the detection cache (see detection_cache_key), no cache if None
+                  filter_chain(FilterChain): Filters applied before the detection, none if None
+                  estimator(str): Noise level of the thresholds, 'std' or 'mad'
 
             Returns:
 
-               SPKS object saved as a *.obj.
+               Detected spikes saved as <MEA>_spikes.h5 (see write_spike_data).
 
               """
 
+    # Electrode 33 is left out of every MEA and is never read from the files #
+
+    exclude = ['33']
+
+    parameters = {'detector': 'recursive', 'version': DETECTION_CACHE_VERSION, 'exclude': exclude,
+                  'estimator': estimator, 'factor': -5.5,
+                  'filters': None if filter_chain is None else {'sos': filter_chain.sos().tolist(),
+                                                                'zero_phase': filter_chain.zero_phase}}
+
     for key in MEAs_paths.keys():
 
         #folder = str(MEAs_paths[key]) + "\\"  # Windows
         folder = str(MEAs_paths[key]) + "/"  # Unix
         MEA = str(key)
 
-        raw_timeseries = RAW_object_constructor(folder, MEA)
+        if cache_path is not None:
 
-        if MEA == "10672" or "10678":
+            cached = cache_path + detection_cache_key(files=raw_data_files(folder, MEA), parameters=parameters,
+                                                      cache_path=cache_path) + '_spikes.h5'
 
-            raw_timeseries = raw_timeseries.exclusion(channel='33')
+            if os.path.exists(cached):
 
-        raw_timeseries.recursive_spike_detection(MEA=MEA, figpath=folder)
+                shutil.copyfile(cached, folder + MEA + '_spikes.h5')
+
+                print('Spike data of MEA', MEA, 'restored from the detection cache', cached)
+
+                continue
+
+        raw_timeseries = RAW_object_constructor(folder, MEA, exclude=exclude, filter_chain=filter_chain)
+
+        raw_timeseries.recursive_spike_detection(MEA=MEA, figpath=folder, estimator=estimator,
+                                                 factor=parameters['factor'])
 
         del raw_timeseries
         gc.collect()
 
+        if cache_path is not None:  # Copied under a temporary name first, so a crash never leaves half a file #
+
+            shutil.copyfile(folder + MEA + '_spikes.h5', cached + '.tmp')
+            os.replace(cached + '.tmp', cached)
+
+
+def raw_data_files(folder, MEA):
+
+    """ Lists the exported *.mat files of a recording, including the parts of long recordings split by the exporter
+    into _RAW_voltage_data_2.mat, _RAW_voltage_data_3.mat, ...
+
+              Arguments:
+
+                  folder(str): Path to the directory where the recording is stored
+                  MEA(str): Number of the MEA recorded
+
+            Returns:
+
+               Dictionary with the uv_data (list), time_array and channelids paths
+
+              """
+
+    uv_data = [folder + MEA + '_RAW_voltage_data.mat']
+    part = 2
+
+    while os.path.exists(folder + MEA + '_RAW_voltage_data_' + str(part) + '.mat'):
+
+        uv_data.append(folder + MEA + '_RAW_voltage_data_' + str(part) + '.mat')
+        part = part + 1
+
+    return {'uv_data': uv_data, 'time_array': folder + MEA + '_time_array_ms.mat',
+            'channelids': folder + MEA + '_correct_electrode_order.mat'}
+
+
+def file_digest(path, cache_path=None):
+
+    """ SHA-256 of a file, read in 1 MiB chunks. With a cache folder the digests are remembered in digests.json together
+    with the size and modification time of the file, so unchanged multi-GB recordings are not read again.
+
+              Arguments:
+
+                  path(str): File to be hashed
+                  cache_path(str): Folder of the detection cache, digests are not remembered if None
+
+            Returns:
+
+               Hexadecimal digest
+
+              """
+
+    status = os.stat(path)
+    stamp = [status.st_size, status.st_mtime_ns]
+    index_path = None if cache_path is None else os.path.join(cache_path, 'digests.json')
+    index = dict()
+
+    if index_path is not None and os.path.exists(index_path):
+
+        with open(index_path) as file:
+
+            index = json.load(file)
+
+        entry = index.get(os.path.abspath(path))
+
+        if entry is not None and entry['stamp'] == stamp:
+
+            return entry['sha256']
+
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+
+            digest.update(chunk)
+
+    if index_path is not None:
+
+        index[os.path.abspath(path)] = {'stamp': stamp, 'sha256': digest.hexdigest()}
+
+        with open(index_path + '.tmp', 'w') as file:
+
+            json.dump(index, file)
+
+        os.replace(index_path + '.tmp', index_path)
+
+    return digest.hexdigest()
+
+
+def detection_cache_key(files, parameters, cache_path=None):
+
+    """ Content address of a detection: SHA-256 of the contents of the input *.mat files and of the detection and
+    filter parameters. The key changes whenever the data or any parameter changes, and not when files are moved.
+
+              Arguments:
+
+                  files(dict): uv_data (list), time_array and channelids paths, see raw_data_files
+                  parameters(dict): JSON-serialisable detection and filter parameters
+                  cache_path(str): Folder of the detection cache, where the file digests are remembered
+
+            Returns:
+
+               Hexadecimal key
+
+              """
+
+    if cache_path is not None:
+
+        os.makedirs(cache_path, exist_ok=True)
+
+    key = hashlib.sha256()
+
+    for role in ('uv_data', 'time_array', 'channelids'):
+
+        paths = files[role] if isinstance(files[role], list) else [files[role]]
+
+        for path in paths:
+
+            key.update((role + ':' + file_digest(path, cache_path=cache_path) + ';').encode())
+
+    key.update(json.dumps(parameters, sort_keys=True).encode())
+
+    return key.hexdigest()
+
 
 def folderwide_complete_analysis(MEAs_paths, output_path):
 
@@ -102,8 +277,16 @@ def folderwide_complete_analysis(MEAs_paths, output_path):
         print('Started the complete analysis for MEA', MEA, 'inside folder', folder, 'at',
               time.asctime(time.localtime(time.time())))
 
-        pickle_object = open(folder+MEA+".obj", 'rb')
-        SPKS = pickle.load(pickle_object)  # Imports the detected spikes
+        if os.path.exists(folder + MEA + "_spikes.h5"):
+
+            # Imports the detected spike times only, the waveforms are not needed here #
+
+            SPKS = SPKS_NeuronalData(input="HDF5", occurrence_ms=folder + MEA + "_spikes.h5", shapedata=False)
+
+        else:
+
+            pickle_object = open(folder+MEA+".obj", 'rb')  # Detections saved before the HDF5 spike data files #
+            SPKS = pickle.load(pickle_object)
 
         # Removing defective electrodes
 
@@ -258,7 +441,11 @@ def MC_detected_ephys_analysis(MEAs_paths, output_path):
         print('Started the complete analysis for MEA', MEA, 'inside folder', folder, 'at',
               time.asctime(time.localtime(time.time())))
 
-        SPKS = SPKS_object_constructor(folder=folder, MEA=MEA)  # Imports the detected spikes
+        # Imports the detected spikes, leaving the defective electrodes out #
+
+        SPKS = SPKS_object_constructor(folder=folder, MEA=MEA,
+                                       exclude=defective_channels(DIV=DIV, defective_electrodes=defective_electrodes,
+                                                                  MEA=MEA))
 
         if SPKS == 0:
 
@@ -266,10 +453,6 @@ def MC_detected_ephys_analysis(MEAs_paths, output_path):
 
         folder_metrics["MEAs"].append(MEA)
 
-        # Removing defective electrodes
-
-        defective_electrode_removal(DIV=DIV, defective_electrodes=defective_electrodes, MEA=MEA, SPKS=SPKS)
-
         MEA_active_elecs = SPKS.active_electrodes()  # How many electrodes were active
 
         SPKS.visualise_rasters(figpath=output_path, MEA=MEA)  # Raster plot of detections
@@ -355,7 +538,7 @@ def MC_detected_ephys_analysis(MEAs_paths, output_path):
     return 0
 
 
-def RAW_object_constructor(folder, MEA):  # Initialising the RAW_NeuronalData object and imports data files. #
+def RAW_object_constructor(folder, MEA, lazy=False, storage='float', exclude=None, filter_chain=None):  # Initialising the RAW_NeuronalData object and imports data files. #
 
     """Constructs a RAW_NeuronalData object from a electrophysiological recording from a multielectrode array exported
     with the MCD_files_export_uV_and_mS_plus_METADATA.m script as *.mat file and runs the object through a bandstop (50Hz,
@@ -365,6 +548,11 @@ def RAW_object_constructor(folder, MEA):  # Initialising the RAW_NeuronalData ob
 
               folder(str): Path to the directory where the recording is stored
               MEA: Number of the MEA recorded
+              lazy(bool): Leaves the voltages on disk and reads each electrode only when it is processed
+              storage(str): 'float' (uV) or 'int16' (ADC counts, a quarter of the memory)
+              exclude(list): Electrodes that are never read from the files (e.g. defective electrodes)
+              filter_chain(FilterChain): Filters applied in a single pass after loading, e.g.
+              FilterChain().notch(f0=50, Q=10).highpass(cutoff=250, order=2), none if None
 
             Returns:
 
@@ -372,29 +560,33 @@ def RAW_object_constructor(folder, MEA):  # Initialising the RAW_NeuronalData ob
 
               """
 
-    uv_data = folder + MEA + '_RAW_voltage_data.mat'
-    time_array = folder + MEA + '_time_array_ms.mat'
-    channelids = folder + MEA + '_correct_electrode_order.mat'
-    uv_data_2 = folder + MEA + '_RAW_voltage_data_2.mat'
+    # Long recordings are split by the exporter into _RAW_voltage_data_2.mat, _RAW_voltage_data_3.mat, ... #
+
+    files = raw_data_files(folder, MEA)
+    uv_data = files['uv_data']
+    time_array = files['time_array']
+    channelids = files['channelids']
 
     print('Started analysis for ', MEA, ' at ',
           time.asctime(time.localtime(time.time())), '. \nCreating RAW_NeuronalData object, please stand by...' )
 
-    raw_data = RAW_NeuronalData(uv_data=uv_data, time_array=time_array, channelids=channelids, input='MATLAB')
+    raw_data = RAW_NeuronalData(uv_data=uv_data, time_array=time_array, channelids=channelids, input='MATLAB',
+                                lazy=lazy, storage=storage, exclude=exclude)
 
     print('RAW_NeuronalData object for ', MEA, ' created at ', time.asctime(time.localtime(time.time())))  # For profiling
 
-    # Filtering #
+    # Filtering, all stages in a single pass #
 
-    # filtered_data = raw_data.bandstop_resonator()
-    # filtered_data = filtered_data.highpass()
+    if filter_chain is not None:
 
-    # print('Data filtered (Notch filter with Q = 10, and fs = 50Hz) at', time.asctime(time.localtime(time.time())))
+        raw_data.apply_filter_chain(filter_chain)
+
+        print('Data filtered (', filter_chain, ') at', time.asctime(time.localtime(time.time())))
 
     return raw_data
 
 
-def SPKS_object_constructor(folder, MEA):  # Initialising the RAW_NeuronalData object and imports data files. #
+def SPKS_object_constructor(folder, MEA, exclude=None):  # Initialising the RAW_NeuronalData object and imports data files. #
 
     """Constructs a SPKS_NeuronalData object from a electrophysiological recording from a multielectrode array exported
     with the MCD_files_export_uV_and_mS_plus_METADATA.m script as *.mat file and runs the object through a bandstop (50Hz,
@@ -404,8 +596,7 @@ def SPKS_object_constructor(folder, MEA):  # Initialising the RAW_NeuronalData o
 
               folder(str): Path to the directory where the recording is stored
               MEA: Number of the MEA recorded
-
-
+              exclude(list): Electrodes left out of the import (e.g. defective electrodes)
 
             Returns:
 
@@ -424,7 +615,7 @@ def SPKS_object_constructor(folder, MEA):  # Initialising the RAW_NeuronalData o
               time.asctime(time.localtime(time.time())), '. \nCreating SPKS_NeuronalData object, please stand by...' )
 
         SPKS = SPKS_NeuronalData(time_array=time_array, channelids=channelids, occurrence_ms=occurrence_ms,
-                                 shapedata=shapedata, input='MATLAB')
+                                 shapedata=shapedata, input='MATLAB', exclude=exclude)
 
         # For profiling #
 
@@ -526,6 +717,6 @@ MEAs_paths = MEA_path_acquisition(full_path)
 
 MC_detected_ephys_analysis(MEAs_paths=MEAs_paths, output_path=full_path)
 
-folderwide_recursive_spike_detection(MEAs_paths)
+folderwide_recursive_spike_detection(MEAs_paths, cache_path=os.path.join(full_path, 'detection_cache', ''))
 
 folderwide_complete_analysis(MEAs_paths=MEAs_paths, output_path=full_path)
\ No newline at end of file
@@ -0,0 +1,99 @@
+from class_RAW_NeuronalData import *
+import os
+import sys
+import time
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+# Benchmark of the thread-parallel per-electrode executor #
+
+# Usage: python benchmark_parallel_channels.py [seconds of recording] [maximum number of workers] #
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+
+def synthetic_recording(seconds, n_channels=60, fs=25000, seed=0):
+
+    """ Generates a RAW_NeuronalData object with Gaussian noise in every electrode
+
+        Arguments:
+
+            seconds(float): Length of the recording
+            n_channels(int): Number of electrodes
+            fs(int): Sampling rate in Hz
+            seed(int): Seed of the random generator
+
+        Returns:
+
+           RAW_NeuronalData object
+        """
+
+    rng = np.random.default_rng(seed)
+    n_samples = int(seconds * fs)
+    times = np.arange(n_samples) * 1000 / fs
+
+    uv_data = dict()
+    time_array = {'mock_spiketimes': list()}
+
+    for channel in range(n_channels):
+
+        uv_data[str(channel + 11)] = rng.normal(0, 10, n_samples)
+        time_array[str(channel + 11)] = times
+
+    return RAW_NeuronalData(uv_data=uv_data, input='RAWdata', time_array=time_array, channelids=None)
+
+
+def best_of(function, repeats=3):
+
+    """ Shortest wall time of a few runs of a function, in seconds """
+
+    timings = list()
+
+    for repeat in range(repeats):
+
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def benchmark(seconds=60, max_workers=None):
+
+    """ Times filtering, threshold estimation and snippet extraction of a synthetic 60 electrode recording with 1 to
+    max_workers threads and prints the speed-up over a single thread
+
+        Arguments:
+
+            seconds(float): Length of the synthetic recording
+            max_workers(int): Largest number of threads, all the cores of the machine if None
+        """
+
+    max_workers = max_workers or os.cpu_count() or 1
+    raw_data = synthetic_recording(seconds)
+    chain = FilterChain().notch(f0=50, Q=10).highpass(cutoff=250, order=2)
+    spike_indices = {key: np.arange(100, len(raw_data.mcd_data[key]) - 100, 250) for key in raw_data.electrodes()}
+
+    tasks = {'filtering': lambda workers: raw_data.sos_filter(chain.sos(), workers=workers),
+             'thresholds': lambda workers: raw_data.channel_thresholds(workers=workers),
+             'snippets': lambda workers: raw_data.extract_snippets(spike_indices, workers=workers)}
+
+    print('Recording of', seconds, 's, 60 electrodes,', os.cpu_count(), 'cores')
+
+    for task, function in tasks.items():
+
+        single = None
+
+        for workers in range(1, max_workers + 1):
+
+            elapsed = best_of(lambda: function(workers))
+            single = elapsed if single is None else single
+
+            print(task.ljust(12), str(workers).rjust(3), 'workers', '%8.3f s' % elapsed,
+                  '  speed-up %5.2f' % (single / elapsed))
+
+
+if __name__ == '__main__':
+
+    benchmark(seconds=float(sys.argv[1]) if len(sys.argv) > 1 else 60,
+              max_workers=int(sys.argv[2]) if len(sys.argv) > 2 else None)
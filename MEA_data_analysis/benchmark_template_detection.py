@@ -0,0 +1,162 @@
+from class_RAW_NeuronalData import *
+import shutil
+import sys
+import tempfile
+import time
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+# Benchmark of the matched-filter template detection against the recursive threshold detection #
+
+# Usage: python benchmark_template_detection.py [seconds of recording] [number of electrodes] #
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+
+def synthetic_spiking_recording(seconds, n_channels=60, rate=5, amplitudes=(15, 60), sigma=10, fs=25000, seed=0):
+
+    """ Generates a RAW_NeuronalData object with Gaussian noise and copies of SPIKE_TEMPLATE of random amplitude
+    imposed at Poisson spike times in every electrode
+
+        Arguments:
+
+            seconds(float): Length of the recording
+            n_channels(int): Number of electrodes
+            rate(float): Firing rate of every electrode in Hz
+            amplitudes(tuple): Smallest and largest apex of the imposed spikes in -uV
+            sigma(float): Standard deviation of the noise in uV
+            fs(int): Sampling rate in Hz
+            seed(int): Seed of the random generator
+
+        Returns:
+
+           RAW_NeuronalData object, and a dictionary with the (apex samples, apex amplitudes) imposed in each electrode
+        """
+
+    rng = np.random.default_rng(seed)
+    n_samples = int(seconds * fs)
+    times = np.arange(n_samples) * 1000 / fs
+    apex = int(np.argmin(SPIKE_TEMPLATE))
+
+    uv_data = dict()
+    time_array = {'mock_spiketimes': list()}
+    truth = dict()
+
+    for channel in range(n_channels):
+
+        key = str(channel + 11)
+        voltage = rng.normal(0, sigma, n_samples)
+
+        # Spikes at least 3 ms apart, so every imposed template is whole and on its own #
+
+        intervals = 75 + rng.exponential(fs / rate, size=int(2 * seconds * rate) + 10).astype(int)
+        starts = np.cumsum(intervals)
+        starts = starts[starts < n_samples - len(SPIKE_TEMPLATE)]
+        scales = rng.uniform(amplitudes[0], amplitudes[1], len(starts)) / -np.min(SPIKE_TEMPLATE)
+
+        for position, scale in zip(starts, scales):
+
+            voltage[position:position + len(SPIKE_TEMPLATE)] += scale * SPIKE_TEMPLATE
+
+        uv_data[key] = voltage
+        time_array[key] = times
+        truth[key] = (starts + apex, scales * -np.min(SPIKE_TEMPLATE))
+
+    return RAW_NeuronalData(uv_data=uv_data, input='RAWdata', time_array=time_array, channelids=None), truth
+
+
+def sensitivity(spike_data, truth, tolerance=5, fs=25000, bins=(15, 30, 45, 60)):
+
+    """ Matches the detected spikes with the imposed ones
+
+        Arguments:
+
+            spike_data(SPKS_NeuronalData): Output of a detection
+            truth(dict): Imposed (apex samples, apex amplitudes) of each electrode
+            tolerance(int): Largest distance in samples between an imposed and a detected apex
+            fs(int): Sampling rate in Hz
+            bins(tuple): Edges of the amplitude classes in -uV
+
+        Returns:
+
+           Fraction of imposed spikes found in each amplitude class and number of detections matching no imposed spike
+        """
+
+    found = np.zeros(len(bins) - 1)
+    imposed = np.zeros(len(bins) - 1)
+    false_detections = 0
+
+    for key, (apexes, amplitudes) in truth.items():
+
+        times = spike_data.trains[key] if key in spike_data.trains.electrodes else list()  # Fewer than 4 are dropped #
+        detected = np.sort(np.rint(np.asarray(times) * fs / 1000))
+
+        nearest = nearest_distance(apexes, detected)
+        unmatched = nearest_distance(detected, apexes) > tolerance
+
+        classes = np.digitize(amplitudes, bins) - 1
+        inside = (classes >= 0) & (classes < len(found))
+
+        imposed += np.bincount(classes[inside], minlength=len(found))
+        found += np.bincount(classes[inside], weights=(nearest <= tolerance)[inside], minlength=len(found))
+        false_detections += int(np.sum(unmatched))
+
+    return found / np.maximum(imposed, 1), false_detections
+
+
+def nearest_distance(samples, others):
+
+    """ Distance in samples from each sample to the nearest of the others, infinite if there are none """
+
+    others = np.concatenate(([-np.inf], np.sort(others), [np.inf]))
+    right = np.searchsorted(others, samples)
+
+    return np.minimum(np.abs(samples - others[right - 1]), np.abs(others[right] - samples))
+
+
+def benchmark(seconds=60, n_channels=60):
+
+    """ Runs the recursive threshold detection and the template detection on the same synthetic recording and prints
+    their wall time, the fraction of imposed spikes they found per amplitude and their false detections
+
+        Arguments:
+
+            seconds(float): Length of the synthetic recording
+            n_channels(int): Number of electrodes
+        """
+
+    raw_data, truth = synthetic_spiking_recording(seconds, n_channels=n_channels)
+    figpath = tempfile.mkdtemp() + os.sep
+
+    detections = {'recursive': lambda data: data.recursive_spike_detection(MEA='benchmark', figpath=figpath,
+                                                                           checkpoint=False),
+                  'template': lambda data: data.template_spike_detection(MEA='benchmark', figpath=figpath)}
+
+    results = dict()
+
+    try:
+
+        for name, detection in detections.items():
+
+            data = deepcopy(raw_data)
+            start = time.perf_counter()
+            spike_data = detection(data)
+            results[name] = (time.perf_counter() - start, sensitivity(spike_data, truth))
+
+    finally:
+
+        shutil.rmtree(figpath, ignore_errors=True)
+
+    print('Recording of', seconds, 's,', n_channels, 'electrodes, noise of 10 uV, times include the threshold plots')
+    print('detection'.ljust(12), 'time'.rjust(10), '  found with apex 15-30 uV  30-45 uV  45-60 uV   false')
+
+    for name, (elapsed, (found, false_detections)) in results.items():
+
+        print(name.ljust(12), '%8.3f s' % elapsed, ' ' * 18, '  '.join('%7.1f%%' % (100 * value) for value in found),
+              str(false_detections).rjust(7))
+
+
+if __name__ == '__main__':
+
+    benchmark(seconds=float(sys.argv[1]) if len(sys.argv) > 1 else 60,
+              n_channels=int(sys.argv[2]) if len(sys.argv) > 2 else 60)
@@ -0,0 +1,312 @@
+from collections import deque, namedtuple
+from class_RAW_NeuronalData import *
+import numpy as np
+import time
+
+
+SpikeEvent = namedtuple('SpikeEvent', ['electrode', 'sample', 'apex', 'waveform'])
+
+
+class OnlineSpikeDetector:
+
+    """ Streaming version of the threshold spike detection for closed-loop experiments (e.g. the Animat platform).
+    Fixed-size blocks of samples of all electrodes are filtered causally (the filter state is carried between blocks),
+    written to a ring buffer and scanned for threshold crossings against an adaptive noise estimate. A spike is emitted
+    as soon as its apex and the 50 samples after it have arrived, so the detection delay is at most 75 + 50 samples
+    after the crossing plus the processing time of the block, which is measured for every block.
+    """
+
+    def __init__(self, electrodes, fs=25000, sos=None, factor=-5.5, capacity=4096, warmup=12500, adaptation=1.0,
+                 before=24, after=50, search=75):
+
+        """ Arguments:
+
+                electrodes(list): Electrode numbers, in the order of the rows of the blocks
+                fs(int): Sampling rate in Hz
+                sos(array): Second-order sections of the causal filter (e.g. FilterChain().highpass(...).sos()),
+                unfiltered if None
+                factor(float): Threshold in units of the noise level
+                capacity(int): Samples kept in the ring buffer, must exceed a block plus search + after + before
+                warmup(int): Samples used to settle the filter and the noise estimate before detecting
+                adaptation(float): Time constant in s of the adaptive noise estimate
+                before(int): Samples of the waveform before the apex
+                after(int): Samples of the waveform after the apex, also the dead time after a spike
+                search(int): Largest number of samples between a crossing and its apex
+            """
+
+        self.electrodes = [str(electrode) for electrode in electrodes]
+        self.fs = fs
+        self.factor = factor
+        self.warmup = warmup
+        self.adaptation = adaptation
+        self.before = before
+        self.after = after
+        self.search = search
+
+        self.filter = None if sos is None else StreamingFilter(sos=sos, zero_phase=False)
+        self.ring = np.zeros((len(self.electrodes), capacity))
+        self.total = 0  # Samples received so far #
+
+        self.sigma = None  # Adaptive noise level (median(|x|) / 0.6745) of each electrode #
+        self.scan_from = np.zeros(len(self.electrodes), dtype=np.int64)  # First sample not yet scanned #
+        self.latencies = deque(maxlen=100000)  # Processing time of each block in s #
+
+    def read(self, start, stop, row=None):
+
+        """ Reads samples [start, stop) of the stream back from the ring buffer
+
+            Arguments:
+
+                start(int): First sample
+                stop(int): Sample after the last one
+                row(int): Row of one electrode, all electrodes if None
+
+            Returns:
+
+               Voltages of one electrode, or a (electrodes x samples) block
+            """
+
+        if start < self.total - self.ring.shape[1] or stop > self.total:
+
+            raise IndexError("Samples " + str(start) + "-" + str(stop) + " are not in the ring buffer")
+
+        columns = np.arange(start, stop) % self.ring.shape[1]
+
+        return self.ring[:, columns] if row is None else self.ring[row, columns]
+
+    def write(self, block):
+
+        """ Appends a (electrodes x samples) block to the ring buffer """
+
+        columns = np.arange(self.total, self.total + block.shape[1]) % self.ring.shape[1]
+        self.ring[:, columns] = block
+        self.total += block.shape[1]
+
+    def update_noise(self, block):
+
+        """ Moves the noise level of each electrode towards the median(|x|) / 0.6745 of the new block, with the time
+        constant given by adaptation """
+
+        block_sigma = np.median(np.abs(block), axis=1) / 0.6745
+
+        if self.sigma is None:
+
+            self.sigma = block_sigma
+
+        else:
+
+            weight = 1 - np.exp(-block.shape[1] / (self.adaptation * self.fs))
+            self.sigma = self.sigma + weight * (block_sigma - self.sigma)
+
+    def process(self, block):
+
+        """ Runs one block of samples through the detector
+
+            Arguments:
+
+                block(array): (electrodes x samples) block of voltages in uV
+
+            Returns:
+
+               List of the SpikeEvents completed by this block
+            """
+
+        started = time.perf_counter()
+
+        block = np.asarray(block, dtype=float)
+
+        if block.shape[1] > self.ring.shape[1] - (self.before + self.search + self.after + 2):
+
+            raise ValueError("Blocks of " + str(block.shape[1]) + " samples do not fit in a ring buffer of " +
+                             str(self.ring.shape[1]) + " samples")
+
+        if self.filter is not None:
+
+            block = self.filter.process(block)
+
+        self.write(block)
+        self.update_noise(block)
+
+        events = list()
+
+        if self.total > self.warmup:
+
+            self.scan_from = np.maximum(self.scan_from, self.warmup)
+            thresholds = self.factor * self.sigma
+
+            # Only electrodes with a crossing in the unscanned samples need a closer look #
+
+            first = int(np.min(self.scan_from))
+            pending = np.any(self.read(first, self.total) < thresholds[:, np.newaxis], axis=1)
+
+            self.scan_from[~pending] = self.total
+
+            for row in np.flatnonzero(pending):
+
+                events.extend(self.scan(row, thresholds[row]))
+
+        self.latencies.append(time.perf_counter() - started)
+
+        return events
+
+    def scan(self, row, threshold):
+
+        """ Looks for spikes of one electrode in the samples not yet scanned, leaving crossings whose apex or
+        post-apex window has not arrived yet for the next block
+
+            Arguments:
+
+                row(int): Row of the electrode
+                threshold(float): Detection threshold (negative)
+
+            Returns:
+
+               List of SpikeEvents
+            """
+
+        events = list()
+        voltage = self.read(self.scan_from[row], self.total, row=row)
+        offset = self.scan_from[row]  # Sample of voltage[0] #
+        position = 0
+
+        while True:
+
+            below = np.flatnonzero(voltage[position:] < threshold)
+
+            if not len(below):
+
+                self.scan_from[row] = offset + len(voltage)
+
+                return events
+
+            crossing = position + below[0]
+            window = voltage[crossing:crossing + self.search + 2]
+            rising = np.flatnonzero(window[:-1] < window[1:])
+
+            if len(rising) and rising[0] <= self.search:
+
+                apex = crossing + rising[0]
+
+            elif len(window) == self.search + 2:
+
+                apex = crossing + self.search
+
+            else:  # The apex has not arrived yet #
+
+                self.scan_from[row] = offset + crossing
+
+                return events
+
+            if apex + self.after >= len(voltage):  # The post-apex window has not arrived yet #
+
+                self.scan_from[row] = offset + crossing
+
+                return events
+
+            start = offset + apex - self.before
+            waveform = np.zeros(self.before + self.after + 1)
+
+            if start >= max(self.total - self.ring.shape[1], 0):
+
+                waveform[:] = self.read(start, offset + apex + self.after + 1, row=row)
+
+            else:  # Apex at the very start of the stream #
+
+                available = max(self.total - self.ring.shape[1], 0)
+                waveform[available - start:] = self.read(available, offset + apex + self.after + 1, row=row)
+
+            events.append(SpikeEvent(electrode=self.electrodes[row], sample=int(offset + apex),
+                                     apex=voltage[apex], waveform=waveform))
+
+            position = apex + self.after  # Dead time, as the samples removed after the apex offline #
+
+    def run(self, source, on_spike=None):
+
+        """ Feeds every block of a source through the detector
+
+            Arguments:
+
+                source(iterable): Blocks of (electrodes x samples) voltages, e.g. a MatFileReplaySource
+                on_spike(callable): Called with each SpikeEvent as soon as it is detected
+
+            Returns:
+
+               List of all SpikeEvents
+            """
+
+        events = list()
+
+        for block in source:
+
+            for event in self.process(block):
+
+                events.append(event)
+
+                if on_spike is not None:
+
+                    on_spike(event)
+
+        return events
+
+    def latency_summary(self):
+
+        """ Processing time per block in ms
+
+            Returns:
+
+               Dictionary with the number of blocks and the median, 99th percentile and maximum latency
+            """
+
+        latencies = np.array(self.latencies) * 1000
+
+        if not len(latencies):
+
+            return {'blocks': 0, 'median': 0.0, 'p99': 0.0, 'max': 0.0}
+
+        return {'blocks': len(latencies), 'median': float(np.median(latencies)),
+                'p99': float(np.percentile(latencies, 99)), 'max': float(np.max(latencies))}
+
+
+class MatFileReplaySource:
+
+    """ Replays a recording exported with MCD_files_export_uV_and_mS_plus_METADATA.m as fixed-size blocks of all
+    electrodes, paced at the speed they were recorded, to test the online detector without a live MEA. The voltages
+    are read lazily from the .mat file one block at a time.
+    """
+
+    def __init__(self, uv_data, time_array, channelids, block_size=250, speed=1.0, channels=None, exclude=None):
+
+        """ Arguments:
+
+                uv_data(str or list): Path(s) of the _RAW_voltage_data.mat file(s), see RAW_NeuronalData
+                time_array(str): Path of the *.mat file containing the recorded timestamps in ms
+                channelids(str): Path of the *.mat file containing the recorded electrode numbers
+                block_size(int): Samples per block (250 samples are 10 ms at 25 kHz)
+                speed(float): Replay speed relative to real time, as fast as possible if None
+                channels(list): Electrode numbers to be replayed, all electrodes if None
+                exclude(list): Electrode numbers left out of the replay
+            """
+
+        self.recording = RAW_NeuronalData(uv_data=uv_data, input='MATLAB', time_array=time_array,
+                                          channelids=channelids, lazy=True, channels=channels, exclude=exclude)
+        self.electrodes = self.recording.electrodes()
+        self.fs = self.recording.time_base.fs
+        self.block_size = block_size
+        self.speed = speed
+
+    def __iter__(self):
+
+        started = time.perf_counter()
+
+        for start, block in self.recording.iter_windows(window=self.block_size, channels=self.electrodes):
+
+            if self.speed is not None:  # Waits until the last sample of the block would have been recorded #
+
+                due = started + (start + block.shape[1]) / (self.fs * self.speed)
+                time.sleep(max(due - time.perf_counter(), 0))
+
+            yield block
+
+    def close(self):
+
+        self.recording.close()
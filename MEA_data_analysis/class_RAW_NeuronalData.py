@@ -1,13 +1,21 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from copy import deepcopy
 from class_SPKS_NeuronalData import *
+from functools import lru_cache
 import gc
 import h5py
+import hashlib
+import json
 import matplotlib.pyplot as plt
+from multiprocessing import shared_memory
 import numpy as np
+import os
 import pickle
 import seaborn as sns
 from scipy import signal, io
 import time
+import warnings
 
 plt.switch_backend('agg')
 plt.rcParams.update({'font.size': 10})
@@ -15,48 +23,136 @@ plt.rcParams.update({'font.size': 10})
 
 class RAW_NeuronalData:
 
-    def __init__(self, uv_data, input, time_array, channelids):
+    def __init__(self, uv_data, input, time_array, channelids, lazy=False, storage='float', channels=None,
+                 exclude=None):
 
         """ Reads multiple *.mat files with empirically recorded neuronal data from multielectrode arrays exported with the
          MCD_files_export_uV_and_mS_plus_METADATA.m script and generates a RAW_NeuronalData object
 
                 Arguments:
 
-                    uvdata (str): path to the *.hdf5 file containing voltage times
+                    uvdata (str or list): path to the *.hdf5 file containing voltage times, or list of paths of a
+                    recording split by the exporter (_RAW_voltage_data.mat, _RAW_voltage_data_2.mat, ...) that are read
+                    as one continuous recording
                     input(str): input source
                     time_array (str): path to the *.mat file containing the recorded timestamps in ms
                     channelids (str): path to the *.mat file containing the recorded electrode numbers
+                    lazy(bool): If True (MATLAB only) the voltages are left on disk and each channel is only read
+                    when a filter or detector touches it
+                    storage(str): 'float' keeps the voltages in uV as float64, 'int16' (MATLAB only) keeps 16-bit ADC
+                    counts plus a gain and offset per channel, converted to uV only when a channel is processed
+                    channels(list): Electrode numbers to be loaded, all electrodes if None
+                    exclude(list): Electrode numbers never read from the files (e.g. defective electrodes)
 
                 Returns:
 
                    RAW_NeuronalData object
                 """
 
+        self.h5files = list()
+        self.valid = {}  # Samples of each electrode not excised by the recursive spike detection #
+        self.noise = {}  # NoiseStatistics of the samples not yet excised #
+        self.spike_rounds = {}  # Detection round of each spike, in the order of the spikeshapes rows #
+        self.channel_index = {}  # Row of each electrode in the channel-major voltage block #
+        self.exclude = sorted(str(channel) for channel in (exclude or []))  # Electrodes left out when loading #
+        self.filters = list()  # Second-order sections of every filter applied, in order #
+        self.gains = None  # uV per ADC count of each row, only for int16 storage #
+        self.offsets = None
+
+        if storage not in ('float', 'int16'):
+
+            raise ValueError("storage must be 'float' or 'int16', not " + str(storage))
+
+        if lazy and storage == 'int16':
+
+            raise ValueError("Lazy loading reads the exported uV values from disk, int16 storage needs lazy=False")
+
         if input == "MATLAB":
 
             self.mcd_data = {}
 
-            file = h5py.File(uv_data, 'r')  # Generating a h5py File Object #
-            array_of_arrays = np.array(file['voltagedata_cell'])  # Converts the object into a numpy array of arrays #
+            if isinstance(uv_data, str):
+
+                uv_data = [uv_data]
 
-            recorded_uvdata = np.transpose(array_of_arrays)  # Transposes it since the data comes rotated #
             recorded_timedata = io.loadmat(time_array)
             recorded_channelids = io.loadmat(channelids)
 
             # The first index after it stands for the matrix line, the second one for the column #
             # Column ZERO has all the channel names, already in the correct order #
 
-            self.mcd_data['ms'] = list()  # First entry of the dictionary will be the time in ms #
-            self.mcd_data['ms'].extend(recorded_timedata['timedata'][0])
-
-            # Then we add the channel IDs and the voltage data #
+            selected = list()  # (Column in the voltage files, channel ID) of the channels to be read #
 
             for channel in range(0, 60):
 
                 key = recorded_channelids['channelID_matrix'][channel][0][0]  # First column has the channel IDs #
 
-                self.mcd_data[key] = list()
-                self.mcd_data[key].extend(recorded_uvdata[channel])  # Filling the arrays with the voltages #
+                if channel_selected(key, channels=channels, exclude=exclude):
+
+                    selected.append((channel, key))
+
+            columns = [channel for channel, key in selected]
+
+            files = [h5py.File(path, 'r') for path in uv_data]  # Generating h5py File Objects #
+
+            if lazy:
+
+                self.h5files = files  # Kept open, channels are read on demand #
+                self.voltages = concatenate_blocks([open_voltage_block(file['voltagedata_cell']) for file in files])
+                rows = columns
+
+            else:
+
+                # Only the selected channels are read from the files #
+
+                file_blocks = concatenate_blocks([H5VoltageBlock(file['voltagedata_cell']) for file in files])
+
+                if storage == 'int16':
+
+                    # Re-encodes the exported uV values as ADC counts, losslessly when they are ADC-derived #
+
+                    self.voltages, self.gains, self.offsets = encode_voltage_block(file_blocks, rows=columns)
+
+                else:
+
+                    # Reads the data straight into a contiguous channels x samples array, since it comes rotated #
+
+                    self.voltages = load_voltage_block(file_blocks, rows=columns)
+
+                rows = list(range(len(selected)))
+
+                for file in files:
+
+                    file.close()
+
+            # First entry of the dictionary will be the time in ms, kept as start, sampling rate and length #
+
+            self.time_base = TimeBase.from_array(recorded_timedata['timedata'][0])
+
+            if len(self.time_base) < self.voltages.shape[1]:  # Split recordings continue the first time array #
+
+                self.time_base = self.time_base.extended(self.voltages.shape[1])
+
+            self.mcd_data['ms'] = self.time_base
+
+            # Then we add the channel IDs and the voltage data #
+
+            for row, (channel, key) in zip(rows, selected):
+
+                self.channel_index[key] = row
+
+                if self.gains is not None:
+
+                    self.mcd_data[key] = LazyChannel(block=self.voltages, row=row, gain=self.gains[row],
+                                                     offset=self.offsets[row])  # Scaled to uV when read #
+
+                elif isinstance(self.voltages, np.ndarray):
+
+                    self.mcd_data[key] = self.voltages[row]  # View into the block (memory-mapped if lazy) #
+
+                else:
+
+                    self.mcd_data[key] = LazyChannel(block=self.voltages, row=row)
 
         elif input == "RAWdata":
 
@@ -67,13 +163,20 @@ class RAW_NeuronalData:
 
             for channel in time_array.keys():
 
-                self.mcd_data['ms'] = list()  # First entry of the dictionary will be the time in ms #
-                self.mcd_data['ms'].extend(time_array[channel])
-
                 if channel != 'mock_spiketimes':  # Avoiding the mock spiketimes
 
-                    self.mcd_data[channel] = list()
-                    self.mcd_data[channel].extend(uv_data[channel])  # Filling the arrays with the voltages #
+                    self.time_base = TimeBase.from_array(time_array[channel])  # Time axis of the channel #
+                    self.mcd_data['ms'] = self.time_base
+
+                    if channel_selected(channel, channels=channels, exclude=exclude):
+
+                        self.channel_index[channel] = len(self.channel_index)
+
+            self.voltages = np.array([uv_data[channel] for channel in self.channel_index], dtype=float)
+
+            for channel in self.channel_index:
+
+                self.mcd_data[channel] = self.voltages[self.channel_index[channel]]  # Filling with the voltages #
 
     def bandstop(self):
 
@@ -86,104 +189,337 @@ class RAW_NeuronalData:
                Filtered RAW_NeuronalData object
             """
 
-        for key in self.mcd_data:
+        sos = butter_bandstop(lowcut=40, highcut=60, fs=25000, order=3, output='sos')
 
-            if key != 'ms':
+        return self.sos_filter(sos=sos, zero_phase=False)  # Causal, as the former lfilter #
 
-                if key != 'mock_spiketimes':
+    def write_channel(self, key, values):
 
-                    self.mcd_data[key] = butter_bandstop_filter(data=self.mcd_data[key], lowcut=40, highcut=60, fs=25000,
-                                                            order=3)
+        """ Stores new voltages (e.g. filtered) for one electrode. Channels that are still views into the channel-major
+        voltage block are overwritten in place, so no new array is kept per electrode. Read-only (lazily loaded) or
+        already detached channels are replaced by the new array.
 
-        return self
+            Arguments:
+
+                key(str): Electrode number
+                values(array): Voltages in uV with the same length as the channel
+            """
 
-    def dynamic_thresholding(self, key, spiketimes, spikeshapes, spikeapexes, threshold_array, round, figpath):
+        channel = self.mcd_data[key]
 
-        """ Reads a RAW_NeuronalData object channel(electrode) and extract spikes for it utilising the recursive spike
-        detection algorithm devised at the University of Reading, altering the dictionaries and returning if a next round
-        is needed
+        if isinstance(channel, LazyChannel) and channel.block is self.voltages and self.gains is not None:
+
+            # int16 storage: the new voltages are encoded again with their own gain and offset #
+
+            gains, offsets = adc_scaling(np.asarray(values, dtype=float)[np.newaxis, :])
+            self.voltages[channel.row] = encode_adc(np.asarray(values)[np.newaxis, :], gains, offsets)[0]
+            self.gains[channel.row] = channel.gain = gains[0]
+            self.offsets[channel.row] = channel.offset = offsets[0]
+
+        elif isinstance(channel, np.ndarray) and channel.flags.writeable and channel.shape == np.shape(values):
+
+            channel[...] = values
+
+        else:
+
+            self.mcd_data[key] = np.asarray(values)
+
+    def close(self):
+
+        """ Closes the *.mat (HDF5) files kept open by a lazily loaded RAW_NeuronalData object. Channels that were not
+        read or filtered before closing can no longer be accessed.
+            """
+
+        for file in self.h5files:
+
+            file.close()
+
+        self.h5files = list()
+
+    def electrodes(self):
+
+        """ Lists the electrode numbers of a RAW_NeuronalData object, skipping the 'ms' and 'mock_spiketimes' entries
+
+            Returns:
+
+               List of electrode numbers
+            """
+
+        return [key for key in self.mcd_data if key != 'ms' and key != 'mock_spiketimes']
+
+    def read_block(self, start, stop, channels=None):
+
+        """ Reads the voltages in uV of a range of samples for several electrodes. Electrodes that are still stored in
+        the voltage block (lazy HDF5 or int16) are read together in a single access.
 
             Arguments:
 
-                key(str): Electrode number
-                spiketimes(dict): Dictionary to save the spiketimes
-                spikeshapes(dict): Dictionary to save the spikeshapes
-                spikeapexes(dict): Dictionary to save the spikeapexes (peaks)
-                threshold_array(dict): Dictionary of the thresholds utilised
+                start(int): First sample
+                stop(int): Sample after the last one
+                channels(list): Electrode numbers, all electrodes if None
 
             Returns:
 
-               Detection signpost
+               (channels x samples) float array
             """
 
-        detection = 0
-        detection_time = 0
+        if channels is None:
 
-        size = len(self.mcd_data[key])
-        threshold = -5.5 * np.std(self.mcd_data[key])  # Sets the threshold in 5.5 STD #
-        threshold_array[key].append(threshold)
+            channels = self.electrodes()
 
-        spikes = 0
-        occurence = 0
+        block = np.empty((len(channels), max(stop - start, 0)), dtype=float)
+        stored = list()  # Positions of the electrodes read straight from the voltage block #
 
-        while spikes < size:  # Flags detected spikes #
+        for position, key in enumerate(channels):
 
-            cutout = 0
+            channel = self.mcd_data[key]
 
-            if self.mcd_data[key][spikes] < threshold:
+            if isinstance(channel, LazyChannel) and channel.block is self.voltages:
 
-                detection = 1
+                stored.append(position)
+
+            else:
 
-                while self.mcd_data[key][spikes + cutout] >= self.mcd_data[key][spikes + cutout + 1] and cutout < 75:
+                block[position] = channel[start:stop]
 
-                    cutout = cutout + 1
+        if stored:
 
-                spike_apex = spikes + cutout  # Lowest point of the spike (i.e. spike time) #
+            rows = [self.mcd_data[channels[position]].row for position in stored]
+            block[stored] = self.voltages[rows, start:stop]
 
-                spikeapexes[key].append(self.mcd_data[key][spike_apex])
-                spikeshapes[key][occurence] = np.zeros(75)
+            for position in stored:
 
-                for backwards in range(0, 25):  # Flags the descent of the spike
+                channel = self.mcd_data[channels[position]]
+                block[position] = channel.scaled(block[position])
 
-                    spikeshapes[key][occurence][24 - backwards] = self.mcd_data[key][spike_apex - backwards]
+        return block
 
-                for forwards in range(0, 50):  # Flags the raise of the spike
+    def iter_windows(self, window=250000, overlap=0, channels=None):
 
-                    spikeshapes[key][occurence][24 + forwards] = self.mcd_data[key][spike_apex + forwards]
+        """ Streams the recording as consecutive windows of all (or some) electrodes, so filters and detectors can run
+        with a peak memory bounded by the window size instead of the recording length. Lazily loaded recordings are
+        read from the HDF5 voltagedata_cell dataset one window at a time.
 
-                plot_spike(voltage=spikeshapes[key][occurence], occurrence=str(occurence), electrode=key,
-                           figpath=figpath, round=str(round))
+            Arguments:
 
-                for del_backwards in range(0, 25):  # Clears for dynamic thresholding
+                window(int): Number of samples per window
+                overlap(int): Number of samples shared by consecutive windows
+                channels(list): Electrode numbers, all electrodes if None
 
-                    self.mcd_data[key] = np.delete(self.mcd_data[key], spike_apex - del_backwards)
+            Returns:
 
-                spike_apex = spike_apex - 25
+               Iterator of (start, block) with the first sample of the window and a (channels x samples) uV array
+            """
 
-                for del_forwards in range(0, 50):  # Clears for dynamic thresholding
+        if not 0 <= overlap < window:
 
-                    self.mcd_data[key] = np.delete(self.mcd_data[key], spike_apex)
+            raise ValueError("The overlap must be at least zero and smaller than the window")
 
-                spike_apex = spikes + cutout
+        if channels is None:
 
-                occurence = occurence + 1
+            channels = self.electrodes()
 
-                if occurence != 0:  # Accounting for the excluded spikes
+        n_samples = len(self.mcd_data['ms'])
+        start = 0
 
-                    detection_time = spike_apex  # 25 samples per ms
-                    spiketimes[key].append(self.mcd_data['ms'][detection_time])
+        while start < n_samples:
 
-                size = len(self.mcd_data[key])  # Updates the size
-                spikes = spikes - 25  # Sets the investigated point to the beginning of the spike before removal
-                # spikes = spikes + 63  # Refractory period of 2.5 ms
+            stop = min(start + window, n_samples)
 
-            else:
+            yield start, self.read_block(start=start, stop=stop, channels=channels)
+
+            if stop == n_samples:
+
+                break
+
+            start = stop - overlap
+
+    def iter_filtered_windows(self, sos, zero_phase=True, window=250000, channels=None, tol=1e-6):
+
+        """ Streams the recording as consecutive filtered windows, so recordings of any length can be filtered with a
+        memory bounded by the window (plus the overlap needed by zero-phase filtering). See StreamingFilter.
+
+            Arguments:
+
+                sos(array): Second-order sections of the filter (e.g. FilterChain.sos())
+                zero_phase(bool): Forward-backward filtering with overlapping blocks if True, causal filtering carrying
+                the filter state across windows if False
+                window(int): Number of samples per window
+                channels(list): Electrode numbers, all electrodes if None
+                tol(float): Relative size of the impulse response below which the filter is considered settled
+
+            Returns:
+
+               Iterator of (start, block) with the first sample of the window and a (channels x samples) uV array
+            """
+
+        return StreamingFilter(sos=sos, zero_phase=zero_phase, tol=tol).filter_windows(self, window=window,
+                                                                                       channels=channels)
+
+    def streamed_thresholds(self, window=250000, factor=-5.5):
+
+        """ Computes the detection threshold (factor * STD) of every electrode from running sums over consecutive
+        windows, without holding a whole channel in memory
+
+            Arguments:
+
+                window(int): Number of samples per window
+                factor(float): Number of standard deviations of the threshold
+
+            Returns:
+
+               Dictionary with the threshold of each electrode
+            """
+
+        channels = self.electrodes()
+        count = 0
+        sums = np.zeros(len(channels))
+        squares = np.zeros(len(channels))
+        reference = None  # Shift of the running sums, keeps the variance numerically stable #
+
+        for start, block in self.iter_windows(window=window, channels=channels):
+
+            if reference is None:
+
+                reference = block[:, 0].copy()
+
+            shifted = block - reference[:, np.newaxis]
+            sums += np.sum(shifted, axis=1)
+            squares += np.sum(shifted * shifted, axis=1)
+            count += block.shape[1]
+
+        variance = np.maximum(squares / count - (sums / count) ** 2, 0)
+
+        return dict(zip(channels, factor * np.sqrt(variance)))
+
+    def channel_thresholds(self, factor=-5.5, workers=1):
+
+        """ Computes the detection threshold (factor * STD) of every electrode, one electrode per task of a
+        ChannelExecutor
+
+            Arguments:
+
+                factor(float): Number of standard deviations of the threshold
+                workers(int): Number of threads, see ChannelExecutor
+
+            Returns:
 
-                spikes = spikes + 1
+               Dictionary with the threshold of each electrode
+            """
+
+        def threshold(key):
+
+            return factor * np.std(np.asarray(self.mcd_data[key], dtype=float))
+
+        return ChannelExecutor(workers=workers).map_channels(threshold, self.electrodes())
+
+    def extract_snippets(self, spike_indices, before=24, after=50, workers=1):
+
+        """ Cuts the voltage snippets around given samples of several electrodes, one electrode per task of a
+        ChannelExecutor. Snippets overlapping the start or the end of the recording are padded with zeros.
+
+            Arguments:
+
+                spike_indices(dict): Samples (e.g. spike apexes) of each electrode
+                before(int): Samples kept before each index
+                after(int): Samples kept after each index
+                workers(int): Number of threads, see ChannelExecutor
+
+            Returns:
+
+               Dictionary with a float32 (spikes x before + after + 1) array of each electrode
+            """
+
+        def snippets(key):
+
+            return gather_snippets(voltage=np.asarray(self.mcd_data[key], dtype=float), indices=spike_indices[key],
+                                   before=before, after=after)
+
+        return ChannelExecutor(workers=workers).map_channels(snippets, list(spike_indices.keys()))
+
+    def dynamic_thresholding(self, key, spiketimes, spikeshapes, spikeapexes, threshold_array, round, figpath,
+                             voltage=None, factor=-5.5):
+
+        """ Reads a RAW_NeuronalData object channel(electrode) and extract spikes for it utilising the recursive spike
+        detection algorithm devised at the University of Reading, altering the dictionaries and returning if a next round
+        is needed. The detected spikes are not deleted from the recording but masked out in self.valid[key], and the
+        spike times are taken at the recording samples of the apexes. The noise level of the threshold comes from
+        self.noise[key], which is updated with the excised samples instead of being recomputed over the whole trace.
+
+            Arguments:
+
+                key(str): Electrode number
+                spiketimes(dict): Dictionary to save the spiketimes
+                spikeshapes(dict): Dictionary to save the spikeshapes
+                spikeapexes(dict): Dictionary to save the spikeapexes (peaks)
+                threshold_array(dict): Dictionary of the thresholds utilised
+                voltage(array): Voltages of the electrode, read from self.mcd_data[key] if None
+                factor(float): Threshold in units of the noise level
+
+            Returns:
+
+               Detection signpost
+            """
+
+        voltage = np.asarray(self.mcd_data[key] if voltage is None else voltage, dtype=float)
+        valid = self.valid.setdefault(key, np.ones(len(voltage), dtype=bool))
+        samples = np.flatnonzero(valid)  # Samples not excised in earlier rounds #
+
+        if key not in self.noise:
+
+            self.noise[key] = NoiseStatistics(voltage=voltage[samples])
+
+        threshold = self.noise[key].threshold(factor=factor)  # Sets the threshold in 5.5 STD by default #
+        threshold_array[key].append(threshold)
+
+        found = detection_round(voltage=voltage[samples], threshold=threshold, samples=samples)  # Flags the spikes #
+
+        detection = self.record_round(key=key, found=found, spiketimes=spiketimes, spikeshapes=spikeshapes,
+                                      spikeapexes=spikeapexes, round=round, voltage=voltage)
+
+        valid[found.removed] = False  # Masked for dynamic thresholding, the recording itself is kept #
+        self.noise[key].remove(voltage[found.removed])  # Updated with the excised samples only #
+
+        return detection
+
+    def record_round(self, key, found, spiketimes, spikeshapes, spikeapexes, round, voltage=None):
+
+        """ Adds the spikes of one detection round of an electrode to the output dictionaries. Only data is recorded
+        here, the spikes are plotted afterwards by plot_detected_spikes if at all.
+
+            Arguments:
+
+                key(str): Electrode number
+                found(DetectionRound): Spikes detected in the round
+                spiketimes(dict): Dictionary to save the spiketimes
+                spikeshapes(dict): Dictionary with the (spikes x 75) float32 spikeshapes matrix of each electrode
+                spikeapexes(dict): Dictionary to save the spikeapexes (peaks)
+                round(str): Round number
+                voltage(array): Voltages of the electrode, read from self.mcd_data[key] if None
+
+            Returns:
+
+               Detection signpost
+            """
+
+        detection = 0
+
+        voltage = self.mcd_data[key] if voltage is None else voltage
+        shapes = gather_snippets(voltage=voltage, indices=found.indices)  # (spikes x 75), apex at 24 #
+        spikeshapes[key] = np.concatenate([spikeshapes[key], shapes])
+        self.spike_rounds.setdefault(key, list()).extend([int(round)] * len(found.indices))
+
+        for occurence in range(len(found.indices)):
+
+            detection = 1
+
+            spikeapexes[key].append(found.apexes[occurence])
+            spiketimes[key].append(self.mcd_data['ms'][found.indices[occurence]])
 
         return detection
 
-    def electrode_spike_detection(self, key, spiketimes, spikeshapes, spikeapexes, threshold_array, figpath):
+    def electrode_spike_detection(self, key, spiketimes, spikeshapes, spikeapexes, threshold_array, figpath,
+                                  estimator='std', factor=-5.5):
 
         """ Reads a RAW_NeuronalData object channel(electrode) and extract spikes for it utilising the recursive spike
        detection algorithm devised at the University of Reading dynamic_thresholding(self, key, spiketimes, spikeshapes,
@@ -196,6 +532,8 @@ class RAW_NeuronalData:
                spikeshapes(dict): Dictionary to save the spikeshapes
                spikeapexes(dict): Dictionary to save the spikeapexes (peaks)
                threshold_array(dict): Dictionary of the thresholds utilised
+               estimator(str): Noise level of the threshold, 'std' or the robust 'mad' (see NoiseStatistics)
+               factor(float): Threshold in units of the noise level
 
            """
 
@@ -203,6 +541,13 @@ class RAW_NeuronalData:
 
             if key != 'mock_spiketimes':
 
+                # Lazy and int16 channels are read in uV for this electrode only, self.mcd_data is left as stored #
+
+                voltage = np.asarray(self.mcd_data[key], dtype=float)
+                self.valid[key] = np.ones(len(voltage), dtype=bool)  # Samples not yet excised #
+                self.noise[key] = NoiseStatistics(voltage=voltage, estimator=estimator)
+                self.spike_rounds[key] = list()
+
                 detection = 1
                 round = 0
 
@@ -210,262 +555,1946 @@ class RAW_NeuronalData:
 
                     print("Round number ", round, " for electrode ", key)
 
-                    # plot_rawdata_singlechannel(self.mcd_data[key], channelnumber=str(key), recursiveround=str(round), figpath=figpath)
+                    # plot_rawdata_singlechannel(self.mcd_data[key], channelnumber=str(key), recursiveround=str(round), figpath=figpath)
+
+                    detection = self.dynamic_thresholding(key=key, spiketimes=spiketimes, spikeshapes=spikeshapes,
+                                                          spikeapexes=spikeapexes, threshold_array=threshold_array,
+                                                          round=str(round), figpath=figpath, voltage=voltage,
+                                                          factor=factor)
+
+                    round = round + 1
+
+        # plot_rawdata_singlechannel(self.mcd_data[key], channelnumber=str(key), recursiveround=str(round), figpath=figpath)
+
+        print("Finished for electrode ", key)
+
+    def exclusion(self, channel):
+
+        """ Remove electrodes from the RAW_NeuronalData object, can be used with user input
+
+            Arguments:
+
+                RAW_NeuronalData object
+
+            Returns:
+
+               Updated RAW_NeuronalData object
+            """
+
+        # print("Please enter one channel to be excluded")
+        # channel = int(input())
+
+        #while channel != 0:
+
+        del self.mcd_data[channel]
+        self.channel_index.pop(channel, None)
+        self.valid.pop(channel, None)
+        self.noise.pop(channel, None)
+        self.spike_rounds.pop(channel, None)
+            #channel = input()
+
+        return self
+
+    def bandstop_resonator(self):
+
+        """ Creates a Notch filter with Q = 10, and fs = 50Hz and runs it through a RAW_NeuronalData object with
+        sampling rate of 25000 samples per second, 25000 Hz.
+
+                       Arguments:
+
+                           RAW_NeuronalData object
+
+                       Returns:
+
+                          Filtered RAW_NeuronalData object
+                       """
+
+        sos = notch_bandstopresonator(f0=0.004, Q=10, output='sos')
+
+        return self.sos_filter(sos=sos, zero_phase=True)
+
+    def highpass(self):
+
+        """ Creates a Butterworth filter with a cutoff of 0.02 times the Nyquist rate, or 20 Hz and runs it through a
+        RAW_NeuronalData object with sampling rate of 25000000 milisamples per second, 25000 Hz.
+
+                Arguments:
+
+                    RAW_NeuronalData object
+
+                Returns:
+
+                   Filtered RAW_NeuronalData object
+                """
+
+        sos = design_filter(kind='highpass', order=2, cutoffs=0.02)
+
+        return self.sos_filter(sos=sos, zero_phase=True)
+
+    def apply_filter_chain(self, chain, batch=8):
+
+        """ Runs all stages of a FilterChain through a RAW_NeuronalData object in a single pass over the data
+
+                Arguments:
+
+                    chain(FilterChain): Cascade of filters to be applied
+                    batch(int): Number of electrodes filtered at once, see sos_filter
+
+                Returns:
+
+                   Filtered RAW_NeuronalData object
+                """
+
+        return self.sos_filter(sos=chain.sos(), zero_phase=chain.zero_phase, batch=batch)
+
+    def sos_filter(self, sos, zero_phase=True, batch=8, workers=1):
+
+        """ Runs a filter given as second-order sections through all electrodes of a RAW_NeuronalData object. The
+        electrodes held in the contiguous voltage block are filtered with batched sosfiltfilt/sosfilt calls along the
+        samples axis and written back in place. Lazily loaded, int16 or detached electrodes are read, filtered and
+        stored in batches of a few electrodes.
+
+                Arguments:
+
+                    sos(array): Second-order sections of the filter (sections x 6)
+                    zero_phase(bool): Forward-backward (sosfiltfilt) if True, causal (sosfilt) if False
+                    batch(int): Number of electrodes filtered together, which bounds the extra memory to a few times
+                    batch rows. If None the voltage block is filtered in one call (about three times its size in
+                    temporary arrays) and the other electrodes 8 at a time
+                    workers(int): Number of threads filtering groups of electrodes concurrently (see ChannelExecutor)
+
+                Returns:
+
+                   Filtered RAW_NeuronalData object
+                """
+
+        self.filters.append({'sos': np.asarray(sos, dtype=float).tolist(), 'zero_phase': bool(zero_phase)})
+
+        executor = ChannelExecutor(workers=workers)
+        in_block = list()  # Electrodes whose data is a row view of the voltage block #
+        others = list()
+
+        for key in self.electrodes():
+
+            if isinstance(self.mcd_data[key], np.ndarray) and self.mcd_data[key].base is self.voltages \
+                    and self.voltages.flags.writeable:
+
+                in_block.append(key)
+
+            else:
+
+                others.append(key)
+
+        if in_block:
+
+            rows = [self.channel_index[key] for key in in_block]
+
+            if batch is None and executor.workers == 1 and rows == list(range(self.voltages.shape[0])):
+
+                self.voltages[...] = filter_block(block=self.voltages, sos=sos, zero_phase=zero_phase)
+
+            else:
+
+                rows_per_call = batch if batch is not None else -(-len(rows) // executor.workers)
+
+                def filter_rows(selected):
+
+                    self.voltages[selected] = filter_block(block=self.voltages[selected], sos=sos,
+                                                           zero_phase=zero_phase)
+
+                executor.map(filter_rows, [rows[first:first + rows_per_call]
+                                           for first in range(0, len(rows), rows_per_call)])
+
+        batch = 8 if batch is None else batch
+
+        def filter_others(keys):
+
+            n_samples = max(len(self.mcd_data[key]) for key in keys)
+
+            if all(len(self.mcd_data[key]) == n_samples for key in keys):
+
+                filtered = filter_block(block=self.read_block(start=0, stop=n_samples, channels=keys), sos=sos,
+                                        zero_phase=zero_phase)
+
+            else:  # Electrodes already cut by the detection have different lengths #
+
+                filtered = [filter_block(block=np.asarray(self.mcd_data[key], dtype=float), sos=sos,
+                                         zero_phase=zero_phase) for key in keys]
+
+            return filtered
+
+        groups = [others[first:first + batch] for first in range(0, len(others), batch)]
+
+        for keys, filtered in zip(groups, executor.map(filter_others, groups)):
+
+            for key, values in zip(keys, filtered):
+
+                self.write_channel(key, values)  # Stored sequentially, int16 rescaling updates shared arrays #
+
+        return self
+
+    def parallel_recursive_spike_detection(self, MEA, figpath, workers=None, estimator='std', spike_plots=None):
+
+        """ Runs the recursive spike detection devised at the University of Reading on several electrodes at once, one
+        electrode per task of a pool of processes, and returns the same SPKS_NeuronalData object as
+        recursive_spike_detection. The voltages are copied once into a shared memory block that the workers read in
+        place, so no recording is pickled between processes. On Windows the calling script has to guard its entry point
+        with if __name__ == '__main__'.
+
+            Arguments:
+
+                MEA(str): MEA number, names the output files
+                figpath(str): Folder of the output files
+                workers(int): Number of processes, all the cores of the machine if None
+                estimator(str): Noise level of the thresholds, 'std' or the robust 'mad' (see NoiseStatistics)
+                spike_plots(str): Spike plots rendered in the background after the detection, 'first', 'random' or
+                'rounds' (see plot_detected_spikes), none if None
+
+            Returns:
+
+               SPKS_NeuronalData object
+            """
+
+        start = time.asctime(time.localtime(time.time()))  # Profiling
+
+        print('Now copying the time series.')
+
+        keys = self.electrodes()
+        n_samples = max([len(self.mcd_data[key]) for key in keys], default=0)
+        shape = (len(keys), n_samples)
+
+        memory = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 1))
+
+        try:
+
+            block = np.ndarray(shape, dtype=float, buffer=memory.buf)
+
+            for first in range(0, len(keys), 8):
+
+                block[first:first + 8] = self.read_block(start=0, stop=n_samples, channels=keys[first:first + 8])
+
+            del block  # The shared memory can only be released once no array points to it #
+
+            tasks = [(memory.name, shape, row, estimator) for row in range(len(keys))]
+
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+
+                results = list(pool.map(shared_electrode_detection, tasks))
+
+        finally:
+
+            memory.close()
+            memory.unlink()
+
+        spiketimes = dict()  # Dictionary that will contain the detected spiketimes
+        spikeshapes = dict()  # Dictionary that will contain the detected spikeshapes
+        spikeapexes = dict()  # Dictionary that will contain the detected spikeapexes
+        threshold_array = dict()  # Dictionary that will contain the threshold computations
+
+        for key, rounds in zip(keys, results):  # Merged in the order of the serial detection #
+
+            threshold_array[key] = [threshold for threshold, found in rounds]
+            spiketimes[key] = list()
+            spikeshapes[key] = np.zeros((0, 75), dtype=np.float32)
+            spikeapexes[key] = list()
+
+            voltage = np.asarray(self.mcd_data[key], dtype=float)  # Read once for the shapes of all rounds #
+            self.valid[key] = np.ones(len(voltage), dtype=bool)
+            self.spike_rounds[key] = list()
+
+            for round, (threshold, found) in enumerate(rounds):
+
+                self.record_round(key=key, found=found, spiketimes=spiketimes, spikeshapes=spikeshapes,
+                                  spikeapexes=spikeapexes, round=str(round), voltage=voltage)
+
+                self.valid[key][found.removed] = False
+
+            print("Finished for electrode ", key)
+
+        finish = time.asctime(time.localtime(time.time()))
+
+        print("Started the parallel detection at", start, "and finished at", finish)  # Profiling
+
+        return self.detection_output(MEA=MEA, figpath=figpath, spiketimes=spiketimes, spikeshapes=spikeshapes,
+                                     threshold_array=threshold_array, spike_plots=spike_plots)
+
+    def detection_fingerprint(self, estimator='std', factor=-5.5):
+
+        """ Describes the data and parameters a detection runs with, so a checkpoint is only resumed by the same job.
+        Besides the detection parameters, it holds the filters applied, the excluded and remaining electrodes, the
+        number of samples and a digest of the first and last second of every electrode, which changes when a recording
+        is exported again.
+
+            Arguments:
+
+                estimator(str): Noise level of the thresholds
+                factor(float): Thresholds in units of the noise level
+
+            Returns:
+
+               JSON-serialisable dictionary
+            """
+
+        n_samples = len(self.mcd_data['ms'])
+        electrodes = self.electrodes()
+        digest = hashlib.sha1()
+
+        for start, stop in ((0, min(25000, n_samples)), (max(n_samples - 25000, 0), n_samples)):
+
+            digest.update(np.ascontiguousarray(self.read_block(start=start, stop=stop, channels=electrodes)).tobytes())
+
+        return {'estimator': estimator, 'factor': float(factor), 'filters': self.filters, 'exclude': self.exclude,
+                'channels': [str(electrode) for electrode in electrodes], 'n_samples': n_samples,
+                'data': digest.hexdigest()}
+
+    def recursive_spike_detection(self, MEA, figpath, estimator='std', spike_plots=None, checkpoint=True,
+                                  factor=-5.5):
+
+        """ Reads a RAW_NeuronalData object and extract spikes for each channel utilising the recursive spike detection
+        algorithm devised at the University of Reading, converting it to a SPKS_NeuronalData object. Every finished
+        electrode is appended to <figpath><MEA>_detection_checkpoint.h5, so a detection that crashed restarts from the
+        electrodes still missing. A checkpoint written for other data, filters, electrodes or detection parameters
+        (see detection_fingerprint) is discarded. The checkpoint is removed once the spike data is saved.
+
+            Arguments:
+
+                MEA(str): MEA number, names the output files
+                figpath(str): Folder of the output files
+                estimator(str): Noise level of the thresholds, 'std' or the robust 'mad' (see NoiseStatistics)
+                spike_plots(str): Spike plots rendered in the background after the detection, 'first', 'random' or
+                'rounds' (see plot_detected_spikes), none if None
+                checkpoint(bool): Writes and resumes from the per-electrode checkpoint
+                factor(float): Thresholds in units of the noise level
+
+            Returns:
+
+               SPKS_NeuronalData object
+            """
+
+        start = time.asctime(time.localtime(time.time()))  # Profiling
+
+        checkpoint_path = figpath + MEA + '_detection_checkpoint.h5'
+        parameters = self.detection_fingerprint(estimator=estimator, factor=factor) if checkpoint else dict()
+        completed = read_checkpoint(path=checkpoint_path, parameters=parameters) if checkpoint else dict()
+
+        spiketimes = dict()  # Dictionary that will contain the detected spiketimes
+        spikeshapes = dict()  # Dictionary that will contain the detected spikeshapes
+        spikeapexes = dict()  # Dictionary that will contain the detected spikeapexes
+        threshold_array = dict()  # Dictionary that will contain the threshold computations
+
+        # ------------------------------------------------------------------------------------------------------------ #
+
+        for key in self.mcd_data:  # Creates the relevant lists #
+
+            if key != 'ms':
+
+                if key != 'mock_spiketimes':
+
+                    threshold_array[key] = list()
+                    spiketimes[key] = list()
+                    spikeshapes[key] = np.zeros((0, 75), dtype=np.float32)
+                    spikeapexes[key] = list()
+
+        for key in self.mcd_data:  # Runs the actual detection per electrode #
+
+            if key != 'ms':
+
+                if key != 'mock_spiketimes':
+
+                    if key in completed:  # Finished before a restart #
+
+                        spiketimes[key] = completed[key]['spiketimes']
+                        spikeshapes[key] = completed[key]['spikeshapes']
+                        spikeapexes[key] = completed[key]['spikeapexes']
+                        threshold_array[key] = completed[key]['thresholds']
+                        self.spike_rounds[key] = completed[key]['rounds']
+
+                        print("Electrode ", key, " restored from the checkpoint")
+
+                        continue
+
+                    self.electrode_spike_detection(key=key, spiketimes=spiketimes, spikeshapes=spikeshapes,
+                                                   spikeapexes=spikeapexes, threshold_array=threshold_array,
+                                                   figpath=figpath, estimator=estimator, factor=factor)
+
+                    if checkpoint:
+
+                        append_checkpoint(path=checkpoint_path, key=key, spiketimes=spiketimes[key],
+                                          spikeshapes=spikeshapes[key], spikeapexes=spikeapexes[key],
+                                          thresholds=threshold_array[key], rounds=self.spike_rounds[key],
+                                          parameters=parameters)
+
+        finish = time.asctime(time.localtime(time.time()))
+
+        print("Started the recursive detection at", start, "and finished at", finish)  # Profiling
+
+        spike_data = self.detection_output(MEA=MEA, figpath=figpath, spiketimes=spiketimes, spikeshapes=spikeshapes,
+                                           threshold_array=threshold_array, spike_plots=spike_plots)
+
+        if checkpoint and os.path.exists(checkpoint_path):  # The spike data file is complete #
+
+            os.remove(checkpoint_path)
+
+        return spike_data
+
+    def template_spike_detection(self, MEA, figpath, templates=None, factor=5.0, window=131072, jitter=3,
+                                 spike_plots=None):
+
+        """ Detects spikes by matched filtering instead of amplitude thresholding. All electrodes are cross-correlated
+        with the spike templates window by window (see template_scores), a spike is a peak of the score, normalised by
+        the noise level of the window, above factor and its apex is the minimum of the recording within jitter samples
+        of the peak. Returns the same SPKS_NeuronalData object as recursive_spike_detection. self.spike_rounds holds
+        the index of the template that matched each spike and the thresholds saved are factor times the noise level of
+        each template's output in uV, which equals the amplitude threshold in white noise.
+
+            Arguments:
+
+                MEA(str): MEA number, names the output files
+                figpath(str): Folder of the output files
+                templates(list): Template or list of templates in uV, SPIKE_TEMPLATE if None
+                factor(float): Smallest score of a spike, in units of the noise level
+                window(int): Number of samples correlated at once
+                jitter(int): Largest distance in samples between the score peak and the apex of the spike
+                spike_plots(str): Spike plots rendered in the background after the detection, 'first', 'random' or
+                'rounds' (see plot_detected_spikes), none if None
+
+            Returns:
+
+               SPKS_NeuronalData object
+            """
+
+        start = time.asctime(time.localtime(time.time()))  # Profiling
+
+        filters, apex = prepare_templates(templates=templates)
+        keys = self.electrodes()
+        n_samples = len(self.mcd_data['ms'])
+        margin = 50 + jitter  # Peaks near the edge of a window are compared with the samples of the next one #
+
+        indices = {key: list() for key in keys}
+        labels = {key: list() for key in keys}
+        sigmas = list()
+
+        for first in range(0, n_samples, window):
+
+            last = min(first + window, n_samples)
+            low = max(first - margin, 0)
+            high = min(last + margin, n_samples)
+
+            # Samples before low and after high feed the filters, zero outside the recording #
+
+            read_from = max(low - apex, 0)
+            read_to = min(high + filters.shape[1] - 1 - apex, n_samples)
+
+            block = self.read_block(start=read_from, stop=read_to, channels=keys)
+            block = np.pad(block, ((0, 0), (read_from - (low - apex), (high + filters.shape[1] - 1 - apex) - read_to)))
+
+            scores, best, sigma = template_scores(block=block, filters=filters)
+            sigmas.append(sigma)
+
+            for row, key in enumerate(keys):
+
+                peaks = template_peaks(scores=scores[row], factor=factor)
+                peaks = peaks[(peaks + low >= first) & (peaks + low < last)]
+
+                # Apex: minimum within jitter samples, block column apex + p is sample low + p #
+
+                columns = apex + peaks[:, np.newaxis] + np.arange(-jitter, jitter + 1)
+                shift = np.argmin(block[row][np.clip(columns, 0, block.shape[1] - 1)], axis=1) - jitter
+
+                indices[key].append(low + peaks + shift)
+                labels[key].append(best[row, peaks])
+
+        spiketimes = dict()  # Dictionary that will contain the detected spiketimes
+        spikeshapes = dict()  # Dictionary that will contain the detected spikeshapes
+        spikeapexes = dict()  # Dictionary that will contain the detected spikeapexes
+        threshold_array = dict()  # Dictionary that will contain the threshold computations
+
+        noise_level = np.mean(sigmas, axis=0) if sigmas else np.zeros((len(keys), len(filters)))
+
+        for row, key in enumerate(keys):
+
+            found = np.concatenate(indices[key] + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+            found = np.clip(found, 0, max(n_samples - 1, 0))  # Apexes searched in the zero padding #
+            voltage = np.asarray(self.mcd_data[key])
+
+            spiketimes[key] = list(np.atleast_1d(self.mcd_data['ms'][found]))
+            spikeshapes[key] = gather_snippets(voltage=voltage, indices=found)
+            spikeapexes[key] = list(voltage[found])
+            threshold_array[key] = list(-factor * noise_level[row])
+            self.spike_rounds[key] = [int(label) for label in np.concatenate(labels[key] + [np.zeros(0, dtype=int)])]
+
+            print("Found ", len(found), " spikes for electrode ", key)
+
+        finish = time.asctime(time.localtime(time.time()))
+
+        print("Started the template detection at", start, "and finished at", finish)  # Profiling
+
+        return self.detection_output(MEA=MEA, figpath=figpath, spiketimes=spiketimes, spikeshapes=spikeshapes,
+                                     threshold_array=threshold_array, spike_plots=spike_plots)
+
+    def detection_output(self, MEA, figpath, spiketimes, spikeshapes, threshold_array, spike_plots=None):
+
+        """ Plots the thresholds and turns the detected spikes into a SPKS_NeuronalData object saved as
+        <figpath><MEA>_spikes.h5. Spike plots, if any, are handed to a background pool and do not hold the detection.
+
+            Arguments:
+
+                MEA(str): MEA number, names the output files
+                figpath(str): Folder of the output files
+                spiketimes(dict): Detected spiketimes of each electrode
+                spikeshapes(dict): Detected spikeshapes of each electrode
+                threshold_array(dict): Thresholds of each electrode and round
+                spike_plots(str): Sampling of the spike plots, see plot_detected_spikes, none if None
+
+            Returns:
+
+               SPKS_NeuronalData object
+            """
+
+        plot_thresholds(figpath=figpath, MEA=MEA, threshold_array=threshold_array)
+
+        duration = len(self.mcd_data['ms'])
+
+        spike_data = SPKS_NeuronalData(input="RAWdata", occurrence_ms=spiketimes, shapedata=spikeshapes,
+                                       duration=duration)
+
+        write_spike_data(spike_data=spike_data, path=figpath + MEA + '_spikes.h5', thresholds=threshold_array,
+                         metadata={'MEA': MEA})
+
+        if spike_plots is not None:
+
+            plot_detected_spikes(spikeshapes=spikeshapes, figpath=figpath, MEA=MEA, rounds=self.spike_rounds,
+                                 mode=spike_plots, background=True)
+
+        del self
+        gc.collect()
+
+        return spike_data
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+# Time base #
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+
+class TimeBase:
+
+    """ Implicit time axis of a recording. Regularly sampled recordings are described only by the time of the first
+    sample, the sampling rate and the number of samples, and sample indices are turned into ms on demand. Irregular
+    time arrays are kept as a fallback array. Behaves like the old list of timestamps for len() and indexing.
+    """
+
+    def __init__(self, start, fs, length, times=None):
+
+        """ Arguments:
+
+                start(float): Time of the first sample in ms
+                fs(float): Sampling rate in Hz
+                length(int): Number of samples
+                times(array): Explicit timestamps in ms, only for irregularly sampled data
+            """
+
+        self.start = float(start)
+        self.fs = float(fs)
+        self.length = int(length)
+        self.times = times
+
+    @classmethod
+    def from_array(cls, times, fs=25000, rtol=1e-6):
+
+        """ Creates a TimeBase from an array of timestamps in ms (e.g. the timedata of a *_time_array_ms.mat file)
+
+            Arguments:
+
+                times(array): Timestamps in ms
+                fs(float): Sampling rate assumed if there are less than two timestamps
+                rtol(float): Largest deviation from a regular grid, as a fraction of the sampling interval
+
+            Returns:
+
+               TimeBase object, with the explicit timestamps kept only if they are not regularly spaced
+            """
+
+        times = np.asarray(times, dtype=float).ravel()
+        length = len(times)
+
+        if length < 2:
+
+            return cls(start=times[0] if length else 0, fs=fs, length=length)
+
+        step = (times[-1] - times[0]) / (length - 1)
+        grid = times[0] + step * np.arange(length)
+
+        if step > 0 and np.max(np.abs(times - grid)) <= rtol * step:
+
+            return cls(start=times[0], fs=1000 / step, length=length)
+
+        return cls(start=times[0], fs=1000 / step if step > 0 else fs, length=length, times=times)
+
+    def __len__(self):
+
+        return self.length
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+
+            index = np.arange(*index.indices(self.length))
+
+        return self.to_ms(index)
+
+    def __array__(self, dtype=None, copy=None):
+
+        times = self.ms()
+
+        return times if dtype is None else times.astype(dtype, copy=False)
+
+    def ms(self):
+
+        """ All timestamps in ms as one array """
+
+        if self.times is not None:
+
+            return np.asarray(self.times, dtype=float)
+
+        return self.start + np.arange(self.length) * (1000 / self.fs)
+
+    def to_ms(self, indices):
+
+        """ Converts sample indices (int or array of ints) into times in ms """
+
+        indices = np.asarray(indices)
+
+        if self.times is not None:
+
+            return self.times[indices]
+
+        if np.any((indices >= self.length) | (indices < -self.length)):
+
+            raise IndexError("Sample index out of range for a recording of " + str(self.length) + " samples")
+
+        indices = np.where(indices < 0, indices + self.length, indices)
+        ms = self.start + indices * (1000 / self.fs)
+
+        return ms[()] if ms.ndim == 0 else ms
+
+    def extended(self, length):
+
+        """ Continues the time axis with the same sampling rate up to a new number of samples (e.g. for a recording
+        split into several files that share the time array of the first one)
+
+            Arguments:
+
+                length(int): New number of samples
+
+            Returns:
+
+               Extended TimeBase object
+            """
+
+        if self.times is None:
+
+            return TimeBase(start=self.start, fs=self.fs, length=length)
+
+        extra = self.times[-1] + (1000 / self.fs) * np.arange(1, length - self.length + 1)
+
+        return TimeBase(start=self.start, fs=self.fs, length=length, times=np.concatenate((self.times, extra)))
+
+    def to_index(self, ms):
+
+        """ Converts times in ms (float or array) into the index of the nearest sample """
+
+        if self.times is not None:
+
+            ms = np.asarray(ms)
+            right = np.clip(np.searchsorted(self.times, ms), 1, self.length - 1)
+            left = right - 1
+            indices = np.where(np.abs(self.times[left] - ms) <= np.abs(self.times[right] - ms), left, right)
+
+        else:
+
+            indices = np.rint((np.asarray(ms) - self.start) * self.fs / 1000).astype(int)
+
+        return indices
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+# Lazy data access #
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+
+class H5VoltageBlock:
+
+    """ Channel-major (channels x samples) view of the voltagedata_cell dataset of a *.mat (v7.3) file. MATLAB stores
+    the 60 x samples matrix rotated, so every channel is a column of the HDF5 dataset. Nothing is read until the block
+    is indexed, and then only the requested samples are read.
+    """
+
+    def __init__(self, dataset):
+
+        self.dataset = dataset
+        self.shape = (dataset.shape[1], dataset.shape[0])
+        self.dtype = dataset.dtype
+        self.ndim = 2
+
+    def __len__(self):
+
+        return self.shape[0]
+
+    def __getitem__(self, index):
+
+        if not isinstance(index, tuple):
+
+            index = (index, slice(None))
+
+        rows, samples = index
+
+        if isinstance(rows, (list, np.ndarray)):  # HDF5 reads need increasing column numbers #
+
+            columns, order = np.unique(rows, return_inverse=True)
+
+            return np.transpose(self.dataset[samples, list(columns)])[order]
+
+        return np.transpose(self.dataset[samples, rows])
+
+
+class ConcatenatedBlock:
+
+    """ Channel-major block made of several blocks placed one after the other in time, e.g. the files of a recording
+    that the exporter split in parts. Reads that cross a file boundary are stitched in memory, so the files are never
+    copied together on disk and filters or detectors see one continuous recording.
+    """
+
+    def __init__(self, blocks):
+
+        self.blocks = blocks
+        self.bounds = np.cumsum([0] + [block.shape[1] for block in blocks])  # First sample of each part #
+
+        if len(set(block.shape[0] for block in blocks)) != 1:
+
+            raise ValueError("All parts of a split recording must have the same number of channels")
+
+        self.shape = (blocks[0].shape[0], int(self.bounds[-1]))
+        self.dtype = np.result_type(*[block.dtype for block in blocks])
+        self.ndim = 2
+
+    def __len__(self):
+
+        return self.shape[0]
+
+    def __getitem__(self, index):
+
+        if not isinstance(index, tuple):
+
+            index = (index, slice(None))
+
+        rows, samples = index
+        n_samples = self.shape[1]
+
+        if isinstance(samples, slice) and samples.step in (None, 1):
+
+            start, stop, step = samples.indices(n_samples)
+            pieces = list()
+
+            for part, block in enumerate(self.blocks):
+
+                low = max(start, self.bounds[part])
+                high = min(stop, self.bounds[part + 1])
+
+                if low < high:
+
+                    pieces.append(np.asarray(block[rows, low - self.bounds[part]:high - self.bounds[part]]))
+
+            if not pieces:
+
+                return np.asarray(self.blocks[0][rows, 0:0])
+
+            return np.concatenate(pieces, axis=-1)
+
+        if isinstance(samples, slice):
+
+            samples = np.arange(*samples.indices(n_samples))
+
+        samples = np.asarray(samples)
+        scalar = samples.ndim == 0
+        samples = np.where(samples < 0, samples + n_samples, np.atleast_1d(samples))
+
+        if np.any((samples < 0) | (samples >= n_samples)):
+
+            raise IndexError("Sample index out of range for a recording of " + str(n_samples) + " samples")
+
+        parts = np.searchsorted(self.bounds, samples, side='right') - 1
+        first = np.asarray(self.blocks[0][rows, 0:1])
+        gathered = np.empty(first.shape[:-1] + (len(samples),), dtype=self.dtype)
+
+        for part in np.unique(parts):
+
+            positions = np.flatnonzero(parts == part)
+            local = samples[positions] - self.bounds[part]
+            window = np.asarray(self.blocks[part][rows, local.min():local.max() + 1])
+            gathered[..., positions] = window[..., local - local.min()]
+
+        return gathered[..., 0] if scalar else gathered
+
+
+def concatenate_blocks(blocks):
+
+    """ Returns the only block of a recording stored in one file, or a ConcatenatedBlock for split recordings """
+
+    if len(blocks) == 1:
+
+        return blocks[0]
+
+    return ConcatenatedBlock(blocks)
+
+
+class LazyChannel:
+
+    """ Single electrode of a lazily loaded (or int16) recording. Behaves like a 1D array of uV: len() and indexing read
+    only the requested samples, and numpy functions (np.std, signal.filtfilt, ...) read the whole channel on demand.
+    ADC counts are scaled with gain * counts + offset when they are read.
+    """
+
+    def __init__(self, block, row, gain=1.0, offset=0.0):
+
+        self.block = block
+        self.row = row
+        self.gain = gain
+        self.offset = offset
+
+    def scaled(self, data):
+
+        if self.gain == 1 and self.offset == 0 and data.dtype.kind == 'f':
+
+            return data
+
+        return data * self.gain + self.offset
+
+    def __len__(self):
+
+        return self.block.shape[1]
+
+    @property
+    def shape(self):
+
+        return (self.block.shape[1],)
+
+    @property
+    def dtype(self):
+
+        return self.block.dtype if self.block.dtype.kind == 'f' else np.dtype(float)
+
+    def __getitem__(self, index):
+
+        return self.scaled(np.asarray(self.block[self.row, index]))[()]
+
+    def __array__(self, dtype=None, copy=None):
+
+        data = self.scaled(np.asarray(self.block[self.row, :]))
+
+        if dtype is not None:
+
+            data = data.astype(dtype, copy=False)
+
+        return data
+
+
+def load_voltage_block(block, chunk_size=250000, rows=None):
+
+    """ Reads a whole channel-major block into one contiguous (channels x samples) float array, chunk by chunk, so the
+    rotated copy of the data is never held in memory at the same time as the result.
+
+        Arguments:
+
+            block(H5VoltageBlock or array): Channel-major block to be read
+            chunk_size(int): Number of samples read at once
+            rows(list): Channels to be read, all channels if None
+
+        Returns:
+
+           Contiguous numpy array with one row per channel
+        """
+
+    rows = slice(None) if rows is None else list(rows)
+    n_channels = block.shape[0] if isinstance(rows, slice) else len(rows)
+    n_samples = block.shape[1]
+    voltages = np.empty((n_channels, n_samples), dtype=float)
+
+    for start in range(0, n_samples, chunk_size):
+
+        stop = min(start + chunk_size, n_samples)
+        voltages[:, start:stop] = block[rows, start:stop]
+
+    return voltages
+
+
+def adc_scaling(block, chunk_size=250000, rtol=1e-3, rows=None):
+
+    """ Finds the gain (uV per count) and offset of each channel to store a block of uV values as 16-bit ADC counts.
+    Values exported with ad2muvolt.m are (counts - ZeroADValue) * MicrovoltsPerAD, so the smallest step between
+    samples recovers MicrovoltsPerAD and the counts are stored without loss. Channels that are not on such a grid (e.g.
+    filtered data) get the gain and offset that spread their range over the int16 range instead.
+
+        Arguments:
+
+            block(H5VoltageBlock or array): Channel-major block of uV values
+            chunk_size(int): Number of samples read at once
+            rtol(float): Largest distance to the ADC grid, as a fraction of a count, still taken as lossless
+            rows(list): Channels to be read, all channels if None
+
+        Returns:
+
+           Arrays with the gain and offset of each channel
+        """
+
+    rows = slice(None) if rows is None else list(rows)
+    n_channels = block.shape[0] if isinstance(rows, slice) else len(rows)
+    n_samples = block.shape[1]
+    lows = np.full(n_channels, np.inf)
+    highs = np.full(n_channels, -np.inf)
+    quantum = None
+
+    for start in range(0, n_samples, chunk_size):
+
+        chunk = np.asarray(block[rows, start:min(start + chunk_size, n_samples)], dtype=float)
+
+        if quantum is None:  # Smallest step between two samples of the first chunk #
+
+            steps = np.abs(np.diff(chunk, axis=1))
+            quantum = np.min(np.where(steps > 0, steps, np.inf), axis=1, initial=np.inf)
+            lossless = np.isfinite(quantum)
+            quantum[~lossless] = 1
+
+        counts = chunk / quantum[:, np.newaxis]
+        lossless &= np.max(np.abs(counts - np.rint(counts)), axis=1, initial=0) <= rtol
+
+        lows = np.minimum(lows, np.min(chunk, axis=1, initial=np.inf))
+        highs = np.maximum(highs, np.max(chunk, axis=1, initial=-np.inf))
+
+    lossless &= np.maximum(np.abs(lows), np.abs(highs)) / quantum <= 32767
+
+    gains = np.where(lossless, quantum, (highs - lows) / 65534)
+    offsets = np.where(lossless, 0.0, (highs + lows) / 2)
+    gains[~(gains > 0)] = 1  # Flat channels #
+
+    return gains, offsets
+
+
+def encode_adc(values, gains, offsets):
+
+    """ Converts a (channels x samples) block of uV values into int16 counts with the gain and offset of each channel """
+
+    counts = np.rint((values - offsets[:, np.newaxis]) / gains[:, np.newaxis])
+
+    return np.clip(counts, -32767, 32767).astype(np.int16)
+
+
+def encode_voltage_block(block, chunk_size=250000, rows=None):
+
+    """ Reads a whole channel-major block of uV values into a contiguous (channels x samples) int16 array of ADC
+    counts, chunk by chunk, taking a quarter of the memory of the float64 block.
+
+        Arguments:
+
+            block(H5VoltageBlock or array): Channel-major block to be read
+            chunk_size(int): Number of samples read at once
+            rows(list): Channels to be read, all channels if None
+
+        Returns:
+
+           int16 array with one row per channel, and the gain and offset of each channel
+        """
+
+    gains, offsets = adc_scaling(block, chunk_size=chunk_size, rows=rows)
+
+    rows = slice(None) if rows is None else list(rows)
+    counts = np.empty((len(gains), block.shape[1]), dtype=np.int16)
+
+    for start in range(0, block.shape[1], chunk_size):
+
+        stop = min(start + chunk_size, block.shape[1])
+        counts[:, start:stop] = encode_adc(np.asarray(block[rows, start:stop], dtype=float), gains, offsets)
+
+    return counts, gains, offsets
+
+
+def open_voltage_block(dataset):
+
+    """ Opens the voltagedata_cell dataset of a *.mat (v7.3) file without reading it. Contiguous (uncompressed,
+    unchunked) datasets are memory-mapped, so every channel is a plain numpy view and the operating system pages the
+    samples in when they are touched. Chunked or compressed datasets fall back to a H5VoltageBlock.
+
+        Arguments:
+
+            dataset(h5py.Dataset): voltagedata_cell dataset of an open h5py File
+
+        Returns:
+
+           Channel-major (channels x samples) numpy memory map or H5VoltageBlock
+        """
+
+    offset = dataset.id.get_offset()
+
+    if dataset.chunks is None and dataset.compression is None and offset is not None:
+
+        memory_map = np.memmap(dataset.file.filename, dtype=dataset.dtype, mode='r', offset=offset,
+                               shape=dataset.shape)
+
+        return np.transpose(memory_map)  # Rows are the channels, as in the eager loading #
+
+    return H5VoltageBlock(dataset)
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+# Parallel execution #
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+
+class ChannelExecutor:
+
+    """ Runs per-electrode work (filters, thresholds, snippet extraction) on a pool of threads. The electrodes share
+    the same voltage block, so nothing is copied between workers, and the SciPy/NumPy kernels doing the work release
+    the GIL, so the electrodes are processed on several cores at once. With one worker everything runs in the calling
+    thread, as before.
+    """
+
+    def __init__(self, workers=1):
+
+        """ Arguments:
+
+                workers(int): Number of threads, all the cores of the machine if None
+            """
+
+        self.workers = (os.cpu_count() or 1) if workers is None else max(int(workers), 1)
+
+    def map(self, function, items):
+
+        """ Applies a function to every item, keeping the order of the results
+
+            Arguments:
+
+                function(callable): Work done for one item (electrode or group of electrodes)
+                items(list): Items to be processed
+
+            Returns:
+
+               List with the result of each item
+            """
+
+        items = list(items)
+
+        if self.workers == 1 or len(items) < 2:
+
+            return [function(item) for item in items]
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(items))) as pool:
+
+            return list(pool.map(function, items))
+
+    def map_channels(self, function, channels):
+
+        """ Applies a function to every electrode
+
+            Arguments:
+
+                function(callable): Work done for one electrode number
+                channels(list): Electrode numbers
+
+            Returns:
+
+               Dictionary with the result of each electrode
+            """
+
+        channels = list(channels)
+
+        return dict(zip(channels, self.map(function, channels)))
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+# Spike detection kernel #
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+DetectionRound = namedtuple('DetectionRound', ['indices', 'apexes', 'removed'])
+
+
+class NoiseStatistics:
+
+    """ Noise level of an electrode during the recursive spike detection. The statistics are built once from the
+    whole trace and then updated with the samples excised in every round, so the threshold of the next round costs
+    O(excised samples) instead of a pass over the multi-million-sample trace.
+
+    'std' keeps shifted running sums of the samples and their squares and gives the same standard deviation as
+    np.std. 'mad' keeps a histogram sketch of the absolute voltages and gives the robust estimate
+    median(|x|) / 0.6745, which the spikes themselves barely inflate, so busy electrodes need fewer rounds.
+    """
+
+    def __init__(self, voltage, estimator='std', bins=16384):
+
+        """ Arguments:
+
+                voltage(array): Voltages of the electrode
+                estimator(str): 'std' or 'mad'
+                bins(int): Number of bins of the 'mad' sketch, its resolution is max(|x|) / bins
+            """
+
+        if estimator not in ('std', 'mad'):
+
+            raise ValueError("estimator must be 'std' or 'mad', not " + str(estimator))
+
+        voltage = np.asarray(voltage, dtype=float)
+
+        self.estimator = estimator
+        self.count = len(voltage)
+
+        if estimator == 'std':
+
+            self.shift = np.mean(voltage) if self.count else 0.0  # Keeps the running sums numerically stable #
+            shifted = voltage - self.shift
+            self.sums = np.sum(shifted)
+            self.squares = np.dot(shifted, shifted)
+
+        else:
+
+            self.bins = bins
+            self.width = max(np.max(np.abs(voltage)) if self.count else 0.0, np.finfo(float).tiny) / bins
+            self.histogram = np.bincount(self.bin(voltage), minlength=bins)
+
+    def bin(self, voltage):
+
+        """ Bin of the sketch of each voltage """
+
+        return np.minimum((np.abs(voltage) / self.width).astype(np.int64), self.bins - 1)
+
+    def remove(self, voltage):
+
+        """ Takes excised samples out of the statistics
+
+            Arguments:
+
+                voltage(array): Voltages of the excised samples
+            """
+
+        voltage = np.asarray(voltage, dtype=float)
+        self.count -= len(voltage)
+
+        if self.estimator == 'std':
+
+            shifted = voltage - self.shift
+            self.sums -= np.sum(shifted)
+            self.squares -= np.dot(shifted, shifted)
+
+        else:
+
+            self.histogram -= np.bincount(self.bin(voltage), minlength=self.bins)
+
+    def sigma(self):
+
+        """ Current noise level in uV """
+
+        if self.count <= 0:
+
+            return 0.0
+
+        if self.estimator == 'std':
+
+            return np.sqrt(max(self.squares / self.count - (self.sums / self.count) ** 2, 0))
+
+        cumulative = np.cumsum(self.histogram)
+        half = self.count / 2
+        median_bin = np.searchsorted(cumulative, half)
+        below = cumulative[median_bin - 1] if median_bin else 0
+        median = (median_bin + (half - below) / self.histogram[median_bin]) * self.width  # Linear within the bin #
+
+        return median / 0.6745
+
+    def threshold(self, factor=-5.5):
+
+        """ Detection threshold, factor times the noise level """
+
+        return factor * self.sigma()
+
+
+def detection_round(voltage, threshold, samples=None, before=24, after=50, search=75):
+
+    """ One round of the recursive spike detection devised at the University of Reading, without a Python loop over
+    the samples. All threshold crossings are found at once with a boolean mask and the apex (lowest point) of each
+    crossing, the first sample before the voltage rises again at most search samples later, with a binary search over
+    the rising samples. The spikes are then taken in order and each removes the 75 samples [apex - 25, apex + 49]
+    from the trace, so crossings inside that dead time are skipped, with one binary search per spike. Samples scanned
+    again after a removal (crossing followed by a descent longer than 25 samples) are handled as in the sample loop.
+    The trace is not modified: the removed samples are returned so the caller can mask them out.
+
+        Arguments:
+
+            voltage(array): Voltages of one electrode still in the trace (not excised in earlier rounds)
+            threshold(float): Detection threshold (negative)
+            samples(array): Sample of the recording each voltage comes from, consecutive samples if None
+            before(int): Samples removed before the apex, on top of the sample right before them
+            after(int): Samples removed from the apex onwards
+            search(int): Largest number of samples between a crossing and its apex
+
+        Returns:
+
+           DetectionRound with the recording sample of each apex, the apex voltages and the recording samples removed
+           in this round (the spike shapes are cut from the recording with gather_snippets)
+        """
+
+    trace = np.asarray(voltage, dtype=float)
+    n_samples = len(trace)
+    samples = np.arange(n_samples) if samples is None else np.asarray(samples)
+    cut = before + 1  # Samples removed up to and including the apex #
+
+    crossings = np.flatnonzero(trace < threshold)
+    rising = np.flatnonzero(trace[:-1] < trace[1:])  # Samples followed by a higher one #
+    next_rising = np.searchsorted(rising, crossings)
+    crossing_apexes = np.minimum(crossings + search, n_samples - 1)
+    has_rising = next_rising < len(rising)
+    crossing_apexes[has_rising] = np.minimum(rising[next_rising[has_rising]], crossing_apexes[has_rising])
+
+    # The trace during the round is the kept prefix buffer[:length] followed by the untouched trace[cursor:] #
+
+    buffer = np.empty(n_samples)
+    buffer_samples = np.empty(n_samples, dtype=samples.dtype)  # Recording sample of each buffered voltage #
+    length = 0
+    cursor = 0
+
+    def extend(stop):  # Copies the untouched trace into the prefix until it holds stop samples #
+
+        nonlocal length, cursor
+
+        count = min(stop - length, n_samples - cursor)
+
+        if count > 0:
+
+            buffer[length:length + count] = trace[cursor:cursor + count]
+            buffer_samples[length:length + count] = samples[cursor:cursor + count]
+            length += count
+            cursor += count
+
+    indices = list()
+    apexes = list()
+    removed = list()
+    position = 0
+
+    while True:
+
+        start = None  # Crossing in the current trace #
+
+        if position < length:  # Samples already scanned, only crossings left before a removal can trigger #
+
+            below = np.flatnonzero(buffer[position:length] < threshold)
+
+            if len(below):
+
+                start = position + below[0]
+                extend(start + search + 2)
+                window = buffer[start:min(start + search + 2, length)]
+                falling = window[:-1] >= window[1:]
+                cutout = np.argmin(falling) if not np.all(falling) else len(falling)
+                apex = start + min(cutout, search, length - 1 - start)
+
+        if start is None:
+
+            crossing = np.searchsorted(crossings, cursor + max(position - length, 0))
+
+            if crossing == len(crossings):
+
+                break
+
+            start = length + crossings[crossing] - cursor
+            apex = length + crossing_apexes[crossing] - cursor
+
+        extend(apex + after)
+
+        indices.append(buffer_samples[apex])
+        apexes.append(buffer[apex])
+
+        # Removal of [apex - 25, apex + 49] from the current trace #
+
+        first = max(apex - cut, 0)
+        removed.append(buffer_samples[first:apex + after].copy())
+
+        for array in (buffer, buffer_samples):
+
+            tail = array[apex + after:length].copy()
+            array[first:first + len(tail)] = tail
+
+        length = first + len(tail)
+        position = max(start - cut, 0)
+
+    removed = np.concatenate(removed) if removed else np.array([], dtype=samples.dtype)
+
+    return DetectionRound(indices=np.array(indices, dtype=int), apexes=np.array(apexes), removed=removed)
+
+
+def gather_snippets(voltage, indices, before=24, after=50, dtype=np.float32):
+
+    """ Cuts the waveforms around many samples of a trace in one fancy-indexing gather
+
+        Arguments:
+
+            voltage(array): Voltages of one electrode
+            indices(array): Samples the snippets are centred on (e.g. spike apexes)
+            before(int): Samples kept before each index
+            after(int): Samples kept after each index
+            dtype: Type of the output
+
+        Returns:
+
+           Contiguous (len(indices) x before + after + 1) matrix, samples outside the trace are 0
+        """
+
+    voltage = np.asarray(voltage)
+    positions = np.asarray(indices, dtype=np.int64).reshape(-1, 1) + np.arange(-before, after + 1)
+    snippets = np.zeros(positions.shape, dtype=dtype)
+
+    if len(voltage):
+
+        inside = (positions >= 0) & (positions < len(voltage))
+        snippets[inside] = voltage[positions[inside]]
+
+    return snippets
+
+
+def recursive_detection(voltage, estimator='std', factor=-5.5):
+
+    """ Runs detection rounds over one electrode until a round finds no spike, masking the spikes of every round out
+    of the next one
+
+        Arguments:
+
+            voltage(array): Voltages of the electrode
+            estimator(str): Noise level of the thresholds, 'std' or 'mad' (see NoiseStatistics)
+            factor(float): Threshold in units of the noise level
+
+        Returns:
+
+           List with the (threshold, DetectionRound) of each round
+        """
+
+    voltage = np.asarray(voltage, dtype=float)
+    valid = np.ones(len(voltage), dtype=bool)
+    noise = NoiseStatistics(voltage=voltage, estimator=estimator)
+    rounds = list()
+
+    while True:
+
+        samples = np.flatnonzero(valid)
+        threshold = noise.threshold(factor=factor)
+        found = detection_round(voltage=voltage[samples], threshold=threshold, samples=samples)
+
+        rounds.append((threshold, found))
+
+        if not len(found.indices):
+
+            return rounds
+
+        valid[found.removed] = False
+        noise.remove(voltage[found.removed])
+
+
+def shared_electrode_detection(task):
+
+    """ Worker of the parallel recursive detection. Reads one electrode from the shared memory block written by
+    RAW_NeuronalData.parallel_recursive_spike_detection and runs recursive_detection on it
+
+        Arguments:
+
+            task(tuple): Name and shape of the shared (electrodes x samples) block, row of the electrode, estimator
+
+        Returns:
+
+           List with the (threshold, DetectionRound) of each round
+        """
+
+    name, shape, row, estimator = task
+    memory = shared_memory.SharedMemory(name=name)
+
+    try:
+
+        rounds = recursive_detection(voltage=np.ndarray(shape, dtype=float, buffer=memory.buf)[row],
+                                     estimator=estimator)
+
+    finally:
+
+        memory.close()
+
+    return rounds
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+# Template matching #
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+SPIKE_TEMPLATE = np.array([1.77083333333333, 1.04166666666667, 1.97916666666667, 2.81250000000000, 1.87500000000000,
+                           1.56250000000000, 2.70833333333333, 2.81250000000000, 3.12500000000000, 3.33333333333333,
+                           2.50000000000000, 1.14583333333333, 1.77083333333333, 2.50000000000000, 0.937500000000000,
+                           0.729166666666667, 1.66666666666667, 2.500000000000, 1.35416666666667, 1.97916666666667,
+                           5.93750000000000, 12.5000000000000, 18.5416666666667, 18.4375000000000, 4.16666666666667,
+                           -21.6666666666667, -39.7916666666667, -40, -31.4583333333333, -22.5000000000000,
+                           -17.2916666666667, -14.5833333333333, -10.8333333333333, -8.22916666666667,
+                           -6.77083333333333, -3.12500000, -2.18750000000000, -1.45833333333333, -0.937500000000000,
+                           0.104166666666667, 3.02083333333333, 2.2916666667, 0.416666666666667, 0.625000000000000,
+                           2.91666666666667, 3.22916666666667, 3.75000000000000, 6.1458333333333, 6.56250000000000,
+                           6.97916666666667, 6.04166666666667, 5.41666666666667, 5.10416666666667, 5.10416666666667,
+                           6.66666666666667, 5.52083333333333, 3.54166666666667, 4.58333333333333, 3.43750000000000,
+                           0.625000000000000, 0.312500000000000, 2.29166666666667, 4.79166666666667, 2.81250000000000,
+                           0.104166666666667, -0.208333333333, -0.833333333333333, -0.416666666666667,
+                           2.08333333333333, 5.31250000000000, 5.10416666666667, 1.04166666667, -0.625000000000000,
+                           -0.104166666666667, 0.312500000000000])  # Biological spike in uV, apex at sample 27 #
+
+
+def prepare_templates(templates=None):
+
+    """ Turns spike templates into matched filters: every template is made zero-mean and unit-norm, so its output is
+    in uV and has the standard deviation of the noise for white noise, and the templates are aligned on their apexes
+    (minimum) by zero padding
+
+        Arguments:
+
+            templates(list): Template or list of templates of any length in uV, SPIKE_TEMPLATE if None
+
+        Returns:
+
+           (templates x width) matrix of filters and the column of the aligned apexes
+        """
+
+    if templates is None:
+
+        templates = [SPIKE_TEMPLATE]
+
+    elif np.ndim(templates[0]) == 0:  # A single template #
+
+        templates = [templates]
+
+    templates = [np.asarray(template, dtype=float) for template in templates]
+    apexes = np.array([np.argmin(template) for template in templates])
+    apex = int(np.max(apexes))
+    width = apex + int(np.max([len(template) for template in templates] - apexes))
+
+    filters = np.zeros((len(templates), width))
+
+    for row, template in enumerate(templates):
+
+        template = template - np.mean(template)
+        norm = np.linalg.norm(template)
+
+        if norm == 0:
+
+            raise ValueError("Template " + str(row) + " is flat and cannot be matched")
+
+        filters[row, apex - apexes[row]:apex - apexes[row] + len(template)] = template / norm
+
+    return filters, apex
+
+
+def template_scores(block, filters):
+
+    """ Cross-correlates every electrode with every template in one batched overlap-add FFT convolution and normalises
+    the output by its noise level (median(|x|) / 0.6745 of each electrode and template)
+
+        Arguments:
+
+            block(array): (channels x samples) voltages in uV
+            filters(array): (templates x width) matched filters of prepare_templates
+
+        Returns:
+
+           (channels x samples - width + 1) best score of every sample, index of the template that gave it and the
+           (channels x templates) noise level of the filter outputs in uV
+        """
+
+    correlation = signal.oaconvolve(block[:, np.newaxis, :], filters[np.newaxis, :, ::-1], mode='valid', axes=-1)
+    sigma = np.median(np.abs(correlation), axis=-1) / 0.6745
+    correlation /= np.where(sigma > 0, sigma, np.inf)[..., np.newaxis]  # Flat electrodes score 0 #
+
+    if correlation.shape[1] == 1:
+
+        return correlation[:, 0], np.zeros(correlation[:, 0].shape, dtype=np.int64), sigma
+
+    labels = np.argmax(correlation, axis=1)
+    scores = np.take_along_axis(correlation, labels[:, np.newaxis, :], axis=1)[:, 0]
+
+    return scores, labels, sigma
+
+
+def template_peaks(scores, factor=5.0, after=50):
+
+    """ Spikes of one electrode in its template scores
+
+        Arguments:
+
+            scores(array): Noise-normalised scores of template_scores
+            factor(float): Smallest score of a spike, in units of the noise level
+            after(int): Smallest distance in samples between two spikes, the lower peak is dropped
+
+        Returns:
+
+           Indices of the spikes in scores
+        """
+
+    peaks, _ = signal.find_peaks(scores, height=factor, distance=after)
+
+    return peaks
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+# Filtering functions #
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+
+FilterResponse = namedtuple('FilterResponse', ['frequencies', 'response', 'group_delay'])
+
+
+def design_filter(kind, order, cutoffs, fs=None, output='sos', Q=None):
+
+    """ Filter registry. Designs a filter from its specification the first time it is asked for and returns the
+    memoised coefficients afterwards, so batch jobs over many MEAs and electrodes do not redesign the same filters. The
+    memoised arrays are read-only and every caller gets its own copy (SciPy's sosfilt needs writable sections).
+
+        Arguments:
+
+            kind(str): 'notch', 'bandstop', 'bandpass', 'highpass' or 'lowpass' (Butterworth, except the notch)
+            order(int): Filter order (ignored for the notch, which is always of order 2)
+            cutoffs(float or tuple): Cutoff frequency, (low, high) for band filters, or centre frequency of the notch
+            fs(float): Sampling rate in Hz, cutoffs are fractions of the Nyquist frequency if None
+            output(str): 'sos' for second-order sections, 'ba' for the transfer function coefficients
+            Q(float): Quality factor of the notch
+
+        Returns:
+
+           Second-order sections, or coefficients b and a
+        """
+
+    coefficients = registered_filter(kind, int(order), hashable_cutoffs(cutoffs), fs, output, Q)
+
+    if output == 'ba':
+
+        return tuple(np.array(array) for array in coefficients)
+
+    return np.array(coefficients)
+
+
+def hashable_cutoffs(cutoffs):
+
+    """ Turns cutoffs given as a number, list or array into a float or a tuple of floats, so equal specifications
+    share one entry of the memoised designs """
+
+    cutoffs = tuple(float(cutoff) for cutoff in np.atleast_1d(cutoffs))
+
+    return cutoffs[0] if len(cutoffs) == 1 else cutoffs
+
+
+@lru_cache(maxsize=256)
+def registered_filter(kind, order, cutoffs, fs, output, Q):
+
+    """ Memoised design behind design_filter, takes only hashable arguments """
+
+    if output not in ('sos', 'ba'):
+
+        raise ValueError("output must be 'sos' or 'ba', not " + str(output))
+
+    if kind == 'notch':
+
+        if Q is None:
+
+            raise ValueError("A notch filter needs a quality factor Q")
+
+        b, a = signal.iirnotch(w0=cutoffs, Q=Q) if fs is None else signal.iirnotch(w0=cutoffs, Q=Q, fs=fs)
+        coefficients = signal.tf2sos(b, a) if output == 'sos' else (b, a)
+
+    elif kind in ('bandstop', 'bandpass', 'highpass', 'lowpass'):
+
+        coefficients = signal.butter(N=order, Wn=cutoffs, btype=kind, fs=fs, output=output)
+
+    else:
+
+        raise ValueError("Unknown filter type " + str(kind))
+
+    for array in (coefficients if output == 'ba' else [coefficients]):
+
+        array.setflags(write=False)
+
+    return coefficients
+
+
+def filter_response(kind, order, cutoffs, fs=None, Q=None, n_points=2048):
+
+    """ Frequency response and group delay of a registered filter, for quality control of the filtering
+
+        Arguments:
+
+            kind, order, cutoffs, fs, Q: Filter specification, see design_filter
+            n_points(int): Number of frequencies between 0 and the Nyquist frequency
+
+        Returns:
+
+           FilterResponse with the frequencies (Hz, or rad/sample if fs is None), the complex response and the group
+           delay in samples
+        """
+
+    return registered_response(kind, int(order), hashable_cutoffs(cutoffs), fs, Q, int(n_points))
+
+
+@lru_cache(maxsize=64)
+def registered_response(kind, order, cutoffs, fs, Q, n_points):
+
+    """ Memoised computation behind filter_response, takes only hashable arguments """
+
+    sos = design_filter(kind=kind, order=order, cutoffs=cutoffs, fs=fs, output='sos', Q=Q)
+    fs = 2 * np.pi if fs is None else fs
+    frequencies = np.linspace(0, fs / 2, n_points, endpoint=False)
+    delay = np.zeros(n_points)
+
+    with warnings.catch_warnings():  # Zeros on the unit circle (e.g. notch) have an undefined delay, set to 0 #
+
+        warnings.simplefilter('ignore')
+
+        for section in sos:  # Group delays of cascaded sections add up #
+
+            delay += signal.group_delay((section[:3], section[3:]), w=frequencies, fs=fs)[1]
+
+    frequencies, response = signal.sosfreqz(sos, worN=frequencies, fs=fs)
+
+    for array in (frequencies, response, delay):
+
+        array.setflags(write=False)
+
+    return FilterResponse(frequencies=frequencies, response=response, group_delay=delay)
+
+
+def butter_bandstop(lowcut, highcut, fs, order, output='ba'):
+
+    """Generate the coefficients for a bandpass filter, give butter() the filter order, the cutoff frequencies
+    Wn=[low, high] (expressed as the fraction of the Nyquist frequency, which is half the sampling frequency) and the
+    band type btype="band".
+
+                Arguments:
+
+                    lowcut(int): Lower cut frequency
+                    highcut(int): Higher cut frequency
+                    fs(int): Frequency of sampling
+                    order(int): Filter order
+                    output(str): 'ba' for the transfer function coefficients, 'sos' for second-order sections
+
+                Returns:
+
+                   Filter coefficients b and a, or second-order sections
+
+                """
+
+    nyq = 0.5 * fs
+    low = lowcut / nyq
+    high = highcut / nyq
+
+    return design_filter(kind='bandstop', order=order, cutoffs=(low, high), output=output)
+
+
+def butter_bandstop_filter(data, lowcut, highcut, fs, order):
+
+    """ Pass a electrode voltage train through a bandpass filter
+
+
+        Arguments:
+
+            data(list): Data to be filtered
+            lowcut(int): Lower cut frequency
+            highcut(int): Higher cut frequency
+            fs(int): Frequency of sampling
+            order(int): Filter order
+
+        Returns:
+
+           Filtered data
+        """
+
+    b, a = butter_bandstop(lowcut=lowcut, highcut=highcut, fs=fs, order=order)
+    y = signal.lfilter(b, a, data)
+
+    return y
+
+
+def notch_bandstopresonator(f0, Q, output='ba'):
+
+    return design_filter(kind='notch', order=2, cutoffs=f0, output=output, Q=Q)
+
+
+def filter_block(block, sos, zero_phase=True):
+
+    """ Filters every row of a (channels x samples) block, or a single channel, in one call along the samples axis
+
+        Arguments:
+
+            block(array): Voltages to be filtered
+            sos(array): Second-order sections of the filter
+            zero_phase(bool): Forward-backward (sosfiltfilt) if True, causal (sosfilt) if False
+
+        Returns:
+
+           Filtered data
+        """
+
+    if zero_phase:
 
-                    detection = self.dynamic_thresholding(key=key, spiketimes=spiketimes, spikeshapes=spikeshapes,
-                                                          spikeapexes=spikeapexes, threshold_array=threshold_array,
-                                                          round=str(round), figpath=figpath)
+        return signal.sosfiltfilt(sos, block, axis=-1)
 
-                    round = round + 1
+    return signal.sosfilt(sos, block, axis=-1)
 
-        # plot_rawdata_singlechannel(self.mcd_data[key], channelnumber=str(key), recursiveround=str(round), figpath=figpath)
 
-        print("Finished for electrode ", key)
+class FilterChain:
 
-    def exclusion(self, channel):
+    """ Declarative cascade of filters (e.g. notch followed by highpass). All stages are designed as second-order
+    sections and stacked into one SOS matrix, so the whole chain runs in a single (zero-phase) pass over the data
+    instead of one full pass and one new array per stage.
 
-        """ Remove electrodes from the RAW_NeuronalData object, can be used with user input
+        Example:
 
-            Arguments:
+            chain = FilterChain(fs=25000).notch(f0=50, Q=10).highpass(cutoff=250, order=2)
+            raw_data.apply_filter_chain(chain)
+    """
 
-                RAW_NeuronalData object
+    def __init__(self, fs=25000, zero_phase=True):
 
-            Returns:
+        """ Arguments:
 
-               Updated RAW_NeuronalData object
+                fs(int): Sampling rate in Hz
+                zero_phase(bool): Forward-backward filtering if True, causal filtering if False
             """
 
-        # print("Please enter one channel to be excluded")
-        # channel = int(input())
+        self.fs = fs
+        self.zero_phase = zero_phase
+        self.stages = list()  # (description, second-order sections) of each stage #
 
-        #while channel != 0:
+    def notch(self, f0, Q):
 
-        del self.mcd_data[channel]
-            #channel = input()
+        """ Adds a notch (band stop resonator) at f0 Hz with quality factor Q """
+
+        self.stages.append(('notch ' + str(f0) + ' Hz',
+                            design_filter(kind='notch', order=2, cutoffs=f0, fs=self.fs, output='sos', Q=Q)))
 
         return self
 
-    def bandstop_resonator(self):
+    def bandstop(self, lowcut, highcut, order):
 
-        """ Creates a Notch filter with Q = 10, and fs = 50Hz and runs it through a RAW_NeuronalData object with
-        sampling rate of 25000 samples per second, 25000 Hz.
+        """ Adds a Butterworth bandstop between lowcut and highcut Hz """
 
-                       Arguments:
+        self.stages.append(('bandstop ' + str(lowcut) + '-' + str(highcut) + ' Hz',
+                            butter_bandstop(lowcut=lowcut, highcut=highcut, fs=self.fs, order=order, output='sos')))
 
-                           RAW_NeuronalData object
+        return self
 
-                       Returns:
+    def highpass(self, cutoff, order):
 
-                          Filtered RAW_NeuronalData object
-                       """
+        """ Adds a Butterworth highpass at cutoff Hz """
 
-        b, a = notch_bandstopresonator(f0=0.004, Q=10)
+        self.stages.append(('highpass ' + str(cutoff) + ' Hz',
+                            design_filter(kind='highpass', order=order, cutoffs=cutoff, fs=self.fs)))
 
-        for key in self.mcd_data:
+        return self
 
-            if key != 'ms':
+    def lowpass(self, cutoff, order):
 
-                if key != 'mock_spiketimes':
+        """ Adds a Butterworth lowpass at cutoff Hz """
 
-                    self.mcd_data[key] = signal.filtfilt(b, a, self.mcd_data[key])
+        self.stages.append(('lowpass ' + str(cutoff) + ' Hz',
+                            design_filter(kind='lowpass', order=order, cutoffs=cutoff, fs=self.fs)))
 
         return self
 
-    def highpass(self):
+    def sos(self):
 
-        """ Creates a Butterworth filter with a cutoff of 0.02 times the Nyquist rate, or 20 Hz and runs it through a
-        RAW_NeuronalData object with sampling rate of 25000000 milisamples per second, 25000 Hz.
+        """ Second-order sections of the whole cascade """
 
-                Arguments:
+        if not self.stages:
 
-                    RAW_NeuronalData object
+            return np.array([[1.0, 0.0, 0.0, 1.0, 0.0, 0.0]])  # Identity filter #
 
-                Returns:
+        return np.vstack([sos for description, sos in self.stages])
 
-                   Filtered RAW_NeuronalData object
-                """
+    def apply(self, block, out=None, batch=8):
 
-        b, a = signal.butter(2, 0.02, btype='highpass')
+        """ Runs the chain through a (channels x samples) block, a few channels at a time
 
-        for key in self.mcd_data:
+            Arguments:
 
-            if key != 'ms':
+                block(array): Voltages to be filtered
+                out(array): Preallocated output of the same shape; the block is overwritten in place if None
+                batch(int): Number of channels filtered at once, bounds the temporary memory to batch rows
 
-                if key != 'mock_spiketimes':
+            Returns:
 
-                    self.mcd_data[key] = signal.filtfilt(b, a, self.mcd_data[key])
+               Filtered block (out)
+            """
 
-        return self
+        out = block if out is None else out
+        sos = self.sos()
 
-    def parallel_recursive_spike_detection(self):
+        if np.ndim(block) == 1:
 
-        """ Attempt to paralelise the detection. Reads a RAW_NeuronalData object and extract spikes for each channel
-        utilising the recursive spike detection algorithm devised at the University of Reading, converting it to a
-        SPKS_NeuronalData object
+            out[...] = filter_block(block=block, sos=sos, zero_phase=self.zero_phase)
 
-            Arguments:
+            return out
 
-                RAW_NeuronalData object
+        for first in range(0, len(block), batch):
 
-            Returns:
+            out[first:first + batch] = filter_block(block=block[first:first + batch], sos=sos,
+                                                    zero_phase=self.zero_phase)
 
-               SPKS_NeuronalData object
-            """
+        return out
 
-        print('Now copying the time series.')
+    def __repr__(self):
 
-        spiketimes = dict()  # Dictionary that will contain the detected spiketimes
-        spikeshapes = dict()  # Dictionary that will contain the detected spikeshapes
-        spikeapexes = dict()  # Dictionary that will contain the detected spikeapexes
-        threshold_array = dict()  # Dictionary that will contain the threshold computations
+        return 'FilterChain(' + ', '.join(description for description, sos in self.stages) + ')'
 
-        # ------------------------------------------------------------------------------------------------------------ #
 
-        for key in self.mcd_data:  # Creates the relevant lists #
+def settling_samples(sos, tol=1e-6):
 
-            if key != 'ms':
-                threshold_array[key] = list()
-                spiketimes[key] = list()
-                spikeshapes[key] = dict()
-                spikeapexes[key] = list()
+    """ Number of samples after which the impulse response of a filter has decayed below tol times its initial size,
+    estimated from the radius of its slowest pole
 
-        pool = mp.Pool(mp.cpu_count())
+        Arguments:
 
-        for key in self.mcd_data:  # Runs the actual detection per electrode #
+            sos(array): Second-order sections of the filter
+            tol(float): Relative size of the impulse response considered negligible
 
-            pool.apply(self.electrode_spike_detection,
-                       args=(self, key, spiketimes, spikeshapes, spikeapexes, threshold_array))
+        Returns:
 
-        del self
-        gc.collect()
+           Number of samples (int)
+        """
 
-    def recursive_spike_detection(self, MEA, figpath):
+    zeros, poles, gain = signal.sos2zpk(sos)
+    radius = np.max(np.abs(poles)) if len(poles) else 0
 
-        """ Reads a RAW_NeuronalData object and extract spikes for each channel utilising the recursive spike detection
-        algorithm devised at the University of Reading, converting it to a SPKS_NeuronalData object
+    if radius == 0:
 
-            Arguments:
+        return len(sos) * 2  # FIR sections settle after their own length #
 
-                RAW_NeuronalData object
+    if radius >= 1:
 
-            Returns:
+        raise ValueError("The filter is unstable, it never settles")
 
-               SPKS_NeuronalData object
-            """
+    return int(np.ceil(np.log(tol) / np.log(radius))) + len(sos) * 2
 
-        start = time.asctime(time.localtime(time.time()))  # Profiling
 
-        spiketimes = dict()  # Dictionary that will contain the detected spiketimes
-        spikeshapes = dict()  # Dictionary that will contain the detected spikeshapes
-        spikeapexes = dict()  # Dictionary that will contain the detected spikeapexes
-        threshold_array = dict()  # Dictionary that will contain the threshold computations
+class StreamingFilter:
 
-        # ------------------------------------------------------------------------------------------------------------ #
+    """ Filters a recording block by block with bounded memory.
 
-        for key in self.mcd_data:  # Creates the relevant lists #
+    Causal filtering (sosfilt) carries the state of every second-order section (zi) from one block to the next, so
+    the concatenated output is the same as filtering the whole trace at once. Zero-phase filtering (sosfiltfilt)
+    reads each block with an overlap on both sides that is as long as the filter takes to settle; the overlap absorbs
+    the edge transients and is discarded, so the kept samples match whole-array filtering within tol. At the ends of
+    the recording the usual sosfiltfilt edge padding applies, as it does for the whole trace.
+    """
 
-            if key != 'ms':
+    def __init__(self, sos, zero_phase=False, tol=1e-6):
 
-                if key != 'mock_spiketimes':
+        """ Arguments:
 
-                    threshold_array[key] = list()
-                    spiketimes[key] = list()
-                    spikeshapes[key] = dict()
-                    spikeapexes[key] = list()
+                sos(array): Second-order sections of the filter
+                zero_phase(bool): Forward-backward filtering if True, causal filtering if False
+                tol(float): Relative size of the impulse response below which the filter is considered settled
+            """
 
-        for key in self.mcd_data:  # Runs the actual detection per electrode #
+        self.sos = np.atleast_2d(sos)
+        self.zero_phase = zero_phase
+        self.overlap = settling_samples(self.sos, tol=tol)
+        self.zi = None  # Filter state carried between blocks (causal mode) #
 
-            if key != 'ms':
+    def reset(self):
 
-                if key != 'mock_spiketimes':
+        """ Forgets the carried filter state, e.g. before a new recording """
 
-                    self.electrode_spike_detection(key=key, spiketimes=spiketimes, spikeshapes=spikeshapes,
-                                                   spikeapexes=spikeapexes, threshold_array=threshold_array,
-                                                   figpath=figpath)
+        self.zi = None
 
-        finish = time.asctime(time.localtime(time.time()))
+    def process(self, chunk):
 
-        plot_thresholds(figpath=figpath, MEA=MEA, threshold_array=threshold_array)
+        """ Causally filters the next chunk of a stream, continuing from the state left by the previous chunk
 
-        print("Started the recursive detection at", start, "and finished at", finish)  # Profiling
+            Arguments:
 
-        duration = len(self.mcd_data['ms'])
+                chunk(array): Next samples of one channel, or a (channels x samples) block
 
-        spike_data = SPKS_NeuronalData(input="RAWdata", occurrence_ms=spiketimes, shapedata=spikeshapes,
-                                       duration=duration)
+            Returns:
 
-        file_pi = open(figpath + MEA + '.obj', 'wb')
-        pickle.dump(spike_data, file_pi)
+               Filtered chunk
+            """
 
-        del self
-        gc.collect()
+        chunk = np.asarray(chunk, dtype=float)
 
-        return spike_data
+        if self.zi is None:
 
-# ----------------------------------------------------------------------------------------------------------------- #
+            self.zi = np.zeros((len(self.sos),) + chunk.shape[:-1] + (2,))
 
-# Filtering functions #
+        filtered, self.zi = signal.sosfilt(self.sos, chunk, axis=-1, zi=self.zi)
 
-# ----------------------------------------------------------------------------------------------------------------- #
+        return filtered
 
+    def filter_windows(self, raw_data, window=250000, channels=None):
 
-def butter_bandstop(lowcut, highcut, fs, order):
+        """ Streams a RAW_NeuronalData recording as consecutive filtered windows
 
-    """Generate the coefficients for a bandpass filter, give butter() the filter order, the cutoff frequencies
-    Wn=[low, high] (expressed as the fraction of the Nyquist frequency, which is half the sampling frequency) and the
-    band type btype="band".
+            Arguments:
 
-                Arguments:
+                raw_data(RAW_NeuronalData): Recording to be filtered
+                window(int): Number of samples per window
+                channels(list): Electrode numbers, all electrodes if None
 
-                    lowcut(int): Lower cut frequency
-                    highcut(int): Higher cut frequency
-                    fs(int): Frequency of sampling
-                    order(int): Filter order
+            Returns:
 
-                Returns:
+               Iterator of (start, block) with the first sample of the window and a (channels x samples) uV array
+            """
 
-                   Filter coefficients b and a
+        if not self.zero_phase:
 
-                """
+            self.reset()
 
-    nyq = 0.5 * fs
-    low = lowcut / nyq
-    high = highcut / nyq
+            for start, block in raw_data.iter_windows(window=window, channels=channels):
 
-    b, a = signal.butter(N=order, Wn=[low, high], btype='bandstop')
+                yield start, self.process(block)
 
-    return b, a
+            return
 
+        n_samples = len(raw_data.mcd_data['ms'])
 
-def butter_bandstop_filter(data, lowcut, highcut, fs, order):
+        for start in range(0, n_samples, window):
 
-    """ Pass a electrode voltage train through a bandpass filter
+            stop = min(start + window, n_samples)
+            first = max(start - self.overlap, 0)
+            last = min(stop + self.overlap, n_samples)
 
+            block = filter_block(block=raw_data.read_block(start=first, stop=last, channels=channels), sos=self.sos,
+                                 zero_phase=True)
 
-        Arguments:
+            yield start, block[..., start - first:stop - first]
 
-            data(list): Data to be filtered
-            lowcut(int): Lower cut frequency
-            highcut(int): Higher cut frequency
-            fs(int): Frequency of sampling
-            order(int): Filter order
+    def filter_to(self, raw_data, out, window=250000, channels=None):
 
-        Returns:
+        """ Filters a whole recording into a preallocated (channels x samples) array, memmap or HDF5 dataset
 
-           Filtered data
-        """
+            Arguments:
 
-    b, a = butter_bandstop(lowcut=lowcut, highcut=highcut, fs=fs, order=order)
-    y = signal.lfilter(b, a, data)
+                raw_data(RAW_NeuronalData): Recording to be filtered
+                out(array): Output with one row per selected electrode
+                window(int): Number of samples per window
+                channels(list): Electrode numbers, all electrodes if None
 
-    return y
+            Returns:
 
+               out
+            """
 
-def notch_bandstopresonator(f0, Q):
+        for start, block in self.filter_windows(raw_data, window=window, channels=channels):
 
-    b, a = signal.iirnotch(w0=f0, Q=Q)
+            out[:, start:start + block.shape[-1]] = block
 
-    return b, a
+        return out
 
 # ----------------------------------------------------------------------------------------------------------------- #
 
@@ -522,19 +2551,7 @@ def create_mockdata(output_path, electrode):
 
         file.close()
 
-        template = [1.77083333333333, 1.04166666666667, 1.97916666666667, 2.81250000000000, 1.87500000000000, 1.56250000000000,
-                    2.70833333333333, 2.81250000000000, 3.12500000000000, 3.33333333333333, 2.50000000000000, 1.14583333333333,
-                    1.77083333333333, 2.50000000000000, 0.937500000000000, 0.729166666666667, 1.66666666666667, 2.500000000000,
-                    1.35416666666667, 1.97916666666667, 5.93750000000000, 12.5000000000000, 18.5416666666667, 18.4375000000000,
-                    4.16666666666667, -21.6666666666667, -39.7916666666667, -40, -31.4583333333333, -22.5000000000000,
-                    -17.2916666666667, -14.5833333333333, -10.8333333333333, -8.22916666666667, -6.77083333333333, -3.12500000,
-                    -2.18750000000000, -1.45833333333333, -0.937500000000000, 0.104166666666667, 3.02083333333333, 2.2916666667,
-                    0.416666666666667, 0.625000000000000, 2.91666666666667, 3.22916666666667, 3.75000000000000, 6.1458333333333,
-                    6.56250000000000, 6.97916666666667, 6.04166666666667, 5.41666666666667, 5.10416666666667, 5.10416666666667,
-                    6.66666666666667, 5.52083333333333, 3.54166666666667, 4.58333333333333, 3.43750000000000, 0.625000000000000,
-                    0.312500000000000, 2.29166666666667, 4.79166666666667, 2.81250000000000, 0.104166666666667, -0.208333333333,
-                    -0.833333333333333, -0.416666666666667, 2.08333333333333, 5.31250000000000, 5.10416666666667, 1.04166666667,
-                    -0.625000000000000, -0.104166666666667, 0.312500000000000]  # Spike shapes to be imposed
+        template = SPIKE_TEMPLATE  # Spike shapes to be imposed
 
         mock_data = impose_template(noise=channel_noise, spikes=spikes, template=template)
 
@@ -678,6 +2695,103 @@ def dict_to_file(dict, filename, output_path):
     file.close()
 
 
+def append_checkpoint(path, key, spiketimes, spikeshapes, spikeapexes, thresholds, rounds, parameters):
+
+    """ Appends one finished electrode to a detection checkpoint. The electrode is written under a temporary name and
+    renamed (and flagged complete) only when all its data is in, and the file is flushed, so a crash during the
+    detection or the writing never leaves a half-written electrode that would be restored.
+
+               Arguments:
+
+                path(str): Checkpoint file, created if missing
+                key(str): Electrode number
+                spiketimes(list): Spike times in ms, in detection order
+                spikeshapes(array): (spikes x 75) spike shapes
+                spikeapexes(list): Apex voltages
+                thresholds(list): Threshold of each round
+                rounds(list): Detection round of each spike
+                parameters(dict): Detection parameters, a checkpoint written with others is not resumed
+
+              Returns:
+
+                 Updated checkpoint file
+
+              """
+
+    with h5py.File(path, 'a') as file:
+
+        file.attrs['parameters'] = json.dumps(parameters, sort_keys=True)
+
+        temporary = 'incomplete_' + str(key)
+
+        if temporary in file:  # Left by a crash while writing #
+
+            del file[temporary]
+
+        group = file.create_group(temporary)
+        group.create_dataset('spiketimes', data=np.asarray(spiketimes, dtype=float))
+        group.create_dataset('spikeshapes', data=np.asarray(spikeshapes, dtype=np.float32).reshape(-1, 75))
+        group.create_dataset('spikeapexes', data=np.asarray(spikeapexes, dtype=float))
+        group.create_dataset('thresholds', data=np.asarray(thresholds, dtype=float))
+        group.create_dataset('rounds', data=np.asarray(rounds, dtype=np.int32))
+        group.attrs['complete'] = True
+
+        if 'electrode_' + str(key) in file:  # Detected again after a restart #
+
+            del file['electrode_' + str(key)]
+
+        file.move(temporary, 'electrode_' + str(key))
+        file.flush()
+
+
+def read_checkpoint(path, parameters):
+
+    """ Reads the electrodes completed in a detection checkpoint
+
+               Arguments:
+
+                path(str): Checkpoint file
+                parameters(dict): Parameters of the detection being resumed
+
+              Returns:
+
+                 Dictionary with spiketimes, spikeshapes, spikeapexes, thresholds and rounds of each completed
+                 electrode, empty if there is no checkpoint. A checkpoint written with other parameters is deleted.
+
+              """
+
+    if not os.path.exists(path):
+
+        return dict()
+
+    completed = dict()
+
+    with h5py.File(path, 'r') as file:
+
+        stale = file.attrs.get('parameters') != json.dumps(parameters, sort_keys=True)
+
+        for name in ([] if stale else file):
+
+            if not name.startswith('electrode_') or not file[name].attrs.get('complete', False):
+
+                continue
+
+            group = file[name]
+            completed[name[len('electrode_'):]] = {'spiketimes': group['spiketimes'][()].tolist(),
+                                                   'spikeshapes': group['spikeshapes'][()],
+                                                   'spikeapexes': group['spikeapexes'][()].tolist(),
+                                                   'thresholds': group['thresholds'][()].tolist(),
+                                                   'rounds': group['rounds'][()].tolist()}
+
+    if stale:  # Its electrodes must not be mixed with the ones of this detection #
+
+        print("Checkpoint", path, "was written for other data or detection parameters and is discarded")
+
+        os.remove(path)
+
+    return completed
+
+
 # ----------------------------------------------------------------------------------------------------------------- #
 
 # Functions for data visualisation #
@@ -776,6 +2890,162 @@ def plot_spike(voltage, occurrence, figpath, electrode, round):
     plt.close(fig)
 
 
+def plot_detected_spikes(spikeshapes, figpath, MEA, rounds=None, mode='first', count=25, per_sheet=25, workers=1,
+                         background=False, seed=0):
+
+    """ Spike plotting stage, run after the detection instead of one dpi=500 figure per spike inside it. A sample of
+    the spikes of each electrode is drawn on contact sheets of per_sheet panels, or each detection round is
+    summarised in one panel, and the figures can be rendered by a pool of background processes.
+
+          Arguments:
+
+              spikeshapes(dict): (spikes x samples) spike shapes of each electrode, in detection order
+              figpath(str): Where to plot the data (full path)
+              MEA(str): MEA number, names the output files
+              rounds(dict): Detection round of each spike of each electrode (RAW_NeuronalData.spike_rounds)
+              mode(str): 'first' for the first count spikes, 'random' for count random spikes, 'rounds' for an
+              overlay of the spikes of each detection round
+              count(int): Number of spikes plotted per electrode ('first' and 'random')
+              per_sheet(int): Number of spikes per contact sheet
+              workers(int): Number of processes rendering the figures, rendered here if 1 and not in background
+              background(bool): If True the figures are left rendering in a process pool and this returns at once
+              seed(int): Seed of the random sample
+
+        Returns:
+
+            List of futures of the figures if rendered by a pool, otherwise an empty list
+
+          """
+
+    if mode not in ('first', 'random', 'rounds'):
+
+        raise ValueError("mode must be 'first', 'random' or 'rounds', not " + str(mode))
+
+    rng = np.random.default_rng(seed)
+    jobs = list()
+
+    for electrode in spikeshapes:
+
+        shapes = np.asarray(spikeshapes[electrode])
+
+        if not len(shapes):
+
+            continue
+
+        electrode_rounds = np.zeros(len(shapes), dtype=int) if rounds is None else np.asarray(rounds[electrode])
+        name = figpath + "MEA_" + str(MEA) + "_Electrode_" + str(electrode) + "_spikes_" + mode
+
+        if mode == 'rounds':
+
+            jobs.append((plot_round_summary, ([shapes[electrode_rounds == round] for round in
+                                               np.unique(electrode_rounds)], np.unique(electrode_rounds).tolist(),
+                                              "MEA " + str(MEA) + " electrode " + str(electrode), name + ".png")))
+
+            continue
+
+        if mode == 'first':
+
+            selected = np.arange(min(count, len(shapes)))
+
+        else:
+
+            selected = np.sort(rng.choice(len(shapes), size=min(count, len(shapes)), replace=False))
+
+        for sheet, first in enumerate(range(0, len(selected), per_sheet)):
+
+            chosen = selected[first:first + per_sheet]
+            labels = ["rd " + str(electrode_rounds[spike]) + " spike " + str(spike) for spike in chosen]
+
+            jobs.append((plot_spike_sheet, (shapes[chosen], labels, name + "_" + str(sheet) + ".png")))
+
+    if workers == 1 and not background:
+
+        for function, arguments in jobs:
+
+            function(*arguments)
+
+        return list()
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+    futures = [pool.submit(function, *arguments) for function, arguments in jobs]
+    pool.shutdown(wait=not background)
+
+    return futures
+
+
+def plot_spike_sheet(shapes, labels, path, columns=5):
+
+    """ Plots several detected spikes as a contact sheet, one small panel per spike
+
+          Arguments:
+
+              shapes(array): (spikes x samples) spike shapes, apex at sample 24
+              labels(list): Title of each panel
+              path(str): File of the figure (full path)
+              columns(int): Panels per row
+
+        Returns:
+
+            Saved plot.
+
+          """
+
+    rows = int(np.ceil(len(shapes) / columns))
+    fig, axes = plt.subplots(rows, columns, figsize=(2 * columns, 1.6 * rows), sharex=True, sharey=True,
+                             squeeze=False, dpi=150)
+
+    for ax, shape, label in zip(axes.flat, shapes, labels):
+
+        ax.plot(shape, linewidth=0.8)
+        ax.set_title(label, fontsize=6)
+
+    for ax in axes.flat[len(shapes):]:
+
+        ax.axis('off')
+
+    fig.supylabel("Voltage (uV)")
+    fig.supxlabel("Data points")
+    fig.tight_layout()
+
+    fig.savefig(path, format='png')
+    plt.close(fig)
+
+
+def plot_round_summary(shapes_per_round, round_numbers, title, path):
+
+    """ Plots the spikes of each detection round of an electrode overlaid in one panel per round, with their mean
+
+          Arguments:
+
+              shapes_per_round(list): (spikes x samples) spike shapes of each round
+              round_numbers(list): Round of each entry of shapes_per_round
+              title(str): Title of the figure
+              path(str): File of the figure (full path)
+
+        Returns:
+
+            Saved plot.
+
+          """
+
+    fig, axes = plt.subplots(1, len(shapes_per_round), figsize=(3 * len(shapes_per_round), 2.5), sharey=True,
+                             squeeze=False, dpi=150)
+
+    for ax, shapes, round in zip(axes.flat, shapes_per_round, round_numbers):
+
+        ax.plot(shapes.T, color='grey', linewidth=0.3, alpha=0.3)
+        ax.plot(np.mean(shapes, axis=0), color='black', linewidth=1)
+        ax.set_title("Round " + str(round) + ", " + str(len(shapes)) + " spikes", fontsize=8)
+
+    fig.suptitle(title)
+    fig.supylabel("Voltage (uV)")
+    fig.supxlabel("Data points")
+    fig.tight_layout()
+
+    fig.savefig(path, format='png')
+    plt.close(fig)
+
+
 def visualise_spikes_generated(output_path):
 
     """ Plots spike times generated with the custom exponential spike generator
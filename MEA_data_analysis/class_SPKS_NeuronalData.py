@@ -1,5 +1,9 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import h5py
 import networkx as nx
 import numpy as np
+import os.path
 import matplotlib.pyplot as plt
 import seaborn as sns
 import scipy.signal as signal
@@ -13,7 +17,7 @@ plt.rcParams.update({'font.size': 4})
 
 class SPKS_NeuronalData:
 
-    def __init__(self, input, occurrence_ms, shapedata, **args):
+    def __init__(self, input, occurrence_ms, shapedata, channels=None, exclude=None, **args):
 
         """ Reads multiple *.mat files with empirically recorded neuronal data from multielectrode arrays exported with
         MCD_files_export_uV_and_mS_plus_METADATA.m script contained pre-detected spike trains and generates a
@@ -22,14 +26,19 @@ class SPKS_NeuronalData:
 
                Arguments:
 
-                   input (str): Either "RAWdata" or "MATLAB" as the source of the data
-                   occurrence_ms(str or dict): path to the *.mat file containing the spike times or dictionary with
-                   spiketimes if the source is "RAWdata".
-                   shapedata(str or dict): path to the *.mat file containing the spike shapes or dictionary with
-                   spikeshapes if the source is "RAWdata".
+                   input (str): Either "RAWdata", "MATLAB" or "HDF5" as the source of the data
+                   occurrence_ms(str or dict): path to the *.mat file containing the spike times, dictionary with
+                   spiketimes if the source is "RAWdata", or path to a spike data file written by write_spike_data if
+                   the source is "HDF5".
+                   shapedata(str, dict or bool): path to the *.mat file containing the spike shapes or dictionary with
+                   the (spikes x samples) spikeshapes matrix of each electrode if the source is "RAWdata". For "HDF5",
+                   True also reads the waveforms and False reads the spike times only. The shapes of each electrode
+                   are kept as one contiguous float32 (spikes x samples) matrix in self.spikeshapes.
                    duration(int): Record duration if the source is "RAWdata"
                    time_array (str): path to the *.mat file containing the recorded timestamps in ms (MATLAB only)
                    channelids (str): path to the *.mat file containing the recorded electrode numbers (MATLAB only)
+                   channels(list): Electrode numbers to be imported, all electrodes if None
+                   exclude(list): Electrode numbers left out of the import (e.g. defective electrodes)
 
                Returns:
 
@@ -37,66 +46,131 @@ class SPKS_NeuronalData:
                """
         # MATLAB input needs the extra arguments time_array and channelids #
 
-        self.spiketimes = {}
+        spiketimes = {}  # Spike times in ms of each electrode, packed into a SpikeTrains container at the end #
         self.spikeshapes = {}
 
         # Imports data #
 
         if input == "MATLAB":
 
-            recorded_timedata = scipy.io.loadmat(args.pop('time_array'))
-            recorded_channelids = scipy.io.loadmat(args.pop('channelids'))
-            input_occurrencedata = scipy.io.loadmat(occurrence_ms)
-            input_shapedata = scipy.io.loadmat(shapedata)
+            # Only the needed variables are parsed from each file #
+
+            recorded_timedata = scipy.io.loadmat(args.pop('time_array'), variable_names=['timedata'])
+            recorded_channelids = scipy.io.loadmat(args.pop('channelids'), variable_names=['channelID_matrix'])
+            input_occurrencedata = scipy.io.loadmat(occurrence_ms, variable_names=['spiketimes'])
+            input_shapedata = scipy.io.loadmat(shapedata, variable_names=['spikedata_cell'])
 
             # The first index after it stands for the matrix line, the second one for the column #
             # Column ZERO has all the channel names, already in the correct order #
 
-            record_duration = len(recorded_timedata['timedata'][0])
+            record_duration = recorded_timedata['timedata'].shape[1]  # Duration of the recording in samples #
 
-            self.spiketimes['duration'] = record_duration  # First entry of the dictionary will be the time in ms #
+            channel_spiketimes = input_occurrencedata['spiketimes'][0:60]
+            channel_shapes = input_shapedata['spikedata_cell'][0:60]
 
             for channel in range(0, 60):
 
                 key = recorded_channelids['channelID_matrix'][channel][0][0]  # First column has the channel IDs #
 
-                spike_number = len(input_occurrencedata['spiketimes'][0:60][channel][0])
+                if not channel_selected(key, channels=channels, exclude=exclude):
 
-                if spike_number > 4:  # Channels with less than or 4 spikes are excluded from further analysis #
+                    continue
 
-                    # Stores the Spike Shapes #
+                # Flattens the (spikes x 1) cell of the channel into the spike times in ms in one operation #
 
-                    self.spikeshapes[key] = list()
-                    transpose = np.transpose(input_shapedata['spikedata_cell'][0:60][channel][0])
-                    self.spikeshapes[key] = transpose
+                electrode_spiketimes = np.ravel(channel_spiketimes[channel][0]).astype(float)
 
-                    # Fills the arrays with the times of spikes in ms #
+                if len(electrode_spiketimes) > 4:  # Channels with 4 spikes or less are excluded from further analysis #
+
+                    # Stores the Spike Shapes #
 
-                    self.spiketimes[key] = list()
+                    self.spikeshapes[key] = np.ascontiguousarray(np.transpose(channel_shapes[channel][0]),
+                                                                 dtype=np.float32)
 
-                    for spike_event in range(0, spike_number):
+                    # Fills the arrays with the times of spikes in ms #
 
-                        self.spiketimes[key].append(input_occurrencedata['spiketimes'][0:60][channel][0][spike_event][0])
+                    spiketimes[key] = electrode_spiketimes
 
         elif input == "RAWdata":
 
+            record_duration = args.pop('duration')
+
             for channel in occurrence_ms.keys():
 
                 # Channels with less than or 4 spikes are excluded from further analysis #
 
-                if len(occurrence_ms[channel]) >= 4:
+                if len(occurrence_ms[channel]) >= 4 and channel_selected(channel, channels=channels, exclude=exclude):
+
+                    # Spikes of later detection rounds are sorted in time, with their shapes in the same order #
+
+                    order = np.argsort(occurrence_ms[channel], kind='stable')
+                    spiketimes[channel] = np.asarray(occurrence_ms[channel], dtype=float)[order]
+
+                    shapes = waveform_matrix(shapedata[channel])
+
+                    if len(shapes) == len(order):
+
+                        self.spikeshapes[channel] = shapes[order]
+
+                    else:  # Shapes of former detections that kept only the last round #
+
+                        self.spikeshapes[channel] = shapes
+
+        elif input == "HDF5":
+
+            with h5py.File(occurrence_ms, 'r') as file:
+
+                check_spike_data_version(file)
+
+                record_duration = file.attrs['duration']
+                electrodes = [electrode.decode() if isinstance(electrode, bytes) else str(electrode)
+                              for electrode in file['electrodes'][()]]
+                offsets = file['offsets'][()]
+                waveform_offsets = file['waveform_offsets'][()] if 'waveforms' in file else None
+
+                # Only the spikes (and waveforms) of the selected electrodes are read from the file #
+
+                for position, key in enumerate(electrodes):
+
+                    if not channel_selected(key, channels=channels, exclude=exclude):
+
+                        continue
+
+                    spiketimes[key] = file['spiketimes'][offsets[position]:offsets[position + 1]]
+
+                    if shapedata and waveform_offsets is not None:
+
+                        first, last = waveform_offsets[position], waveform_offsets[position + 1]
+                        self.spikeshapes[key] = file['waveforms'][first:last]
+
+        self.trains = SpikeTrains.from_dict(spiketimes, duration=record_duration)
+
+    @property
+    def spiketimes(self):
+
+        """ Dictionary with the record duration under 'duration' and a zero-copy view of the spike times of each
+        electrode, as the spike trains were stored before the SpikeTrains container. Prefer self.trains in new code.
+            """
+
+        spiketimes = {'duration': self.trains.duration}
+
+        for electrode in self.trains:
+
+            spiketimes[electrode] = self.trains[electrode]
 
-                    self.spiketimes[channel] = occurrence_ms[channel]
+        return spiketimes
 
-            self.spiketimes['duration'] = args.pop('duration')
+    def __setstate__(self, state):
 
-            for channel in self.spiketimes.keys():
+        # Objects pickled before the SpikeTrains container kept a dictionary of lists plus 'duration' #
 
-                if channel != 'duration':
+        if 'trains' not in state:
 
-                    if len(occurrence_ms[channel]) >= 4:
+            spiketimes = dict(state.pop('spiketimes'))
+            duration = spiketimes.pop('duration')
+            state['trains'] = SpikeTrains.from_dict(spiketimes, duration=duration)
 
-                        self.spikeshapes[channel] = shapedata[channel]
+        self.__dict__.update(state)
 
     def exclusion(self, channel):
 
@@ -112,12 +186,13 @@ class SPKS_NeuronalData:
                Updated SPKS_NeuronalData object
             """
 
-        for electrodes in channel:
+        electrodes = [electrode for electrode in self.trains if str(electrode) in [str(key) for key in channel]]
 
-            if str(electrodes) in self.spiketimes:
+        self.trains = self.trains.drop(electrodes)
 
-                del self.spiketimes[str(electrodes)]
-                del self.spikeshapes[str(electrodes)]
+        for electrode in electrodes:
+
+            self.spikeshapes.pop(electrode, None)  # No shapes if they were not read (e.g. HDF5 with shapedata=False) #
 
 
 # ----------------------------------------------------------------------------------------------------------------- #
@@ -140,29 +215,15 @@ class SPKS_NeuronalData:
 
             """
 
-        firingrates = {}
-
-        # Compute the record duration to seconds from ms #
-
-        duration_ms = self.spiketimes['duration']
-        duration_s = duration_ms / 25000
-
-        for key in self.spiketimes.keys():
+        # Compute the record duration to seconds from samples #
 
-            if key != 'duration':
+        duration_s = self.trains.duration / self.trains.fs
 
-                if key != 'mock_spiketimes':
+        # Spike number per electrode, for all electrodes at once #
 
-                    # Compute the total spike number per electrode
+        electrode_fr_s = self.trains.counts() / duration_s
 
-                    spike_number = len(self.spiketimes[key])
-
-                    # Compute and store the firing rates #
-
-                    electrode_fr_s = spike_number / duration_s
-                    firingrates[key] = electrode_fr_s
-
-        return firingrates
+        return dict(zip(self.trains.electrodes, electrode_fr_s.tolist()))
 
     def MEA_overall_firingrate(self):
 
@@ -178,18 +239,10 @@ class SPKS_NeuronalData:
 
             """
 
-        individual_fr = self.electrode_FR()
-        spikecount = 0
-
-        for key in individual_fr:
-
-            spikecount = individual_fr[key] + spikecount
-
-        if len(self.spiketimes.keys()) > 1:
-
-            active = len(self.spiketimes.keys()) - 1
+        if len(self.trains) > 0:
 
-            overall_firingrate_s = spikecount / active
+            overall_firingrate_s = np.sum(self.trains.counts()) / (self.trains.duration / self.trains.fs)
+            overall_firingrate_s = overall_firingrate_s / len(self.trains)
 
         else:
 
@@ -201,18 +254,12 @@ class SPKS_NeuronalData:
 
         fullname = output_path + filename + ".txt"
         file = open(fullname, "w+")
-        all_detections = 0
+        all_detections = int(np.sum(self.trains.counts()))
 
-        for key in self.spiketimes.keys():
+        for key, spike_number in zip(self.trains.electrodes, self.trains.counts()):
 
-            if key != 'duration':
-
-                # Compute the total spike number per electrode #
-
-                spike_number = len(self.spiketimes[key])
-                electrode_detections = "Electrode " + str(key) + " had " + str(spike_number) + " detections. \n"
-                file.write(str(electrode_detections))
-                all_detections = all_detections + spike_number
+            electrode_detections = "Electrode " + str(key) + " had " + str(spike_number) + " detections. \n"
+            file.write(str(electrode_detections))
 
         overall_detections = "This MEA had " + str(all_detections) + " spikes."
         file.write(str(overall_detections))
@@ -250,11 +297,9 @@ class SPKS_NeuronalData:
 
         overallIBI = dict()
 
-        for electrode in self.spiketimes.keys():  # Computing it for all channels #
+        for electrode in self.trains:  # Computing it for all channels #
 
-            if electrode == 'duration':  # First position on the spiketimes dictionary is the duration of recording #
-
-                continue
+            train = self.trains[electrode]  # Zero-copy view of the spike times of the electrode #
 
             print('Channel analysed: ', electrode)
 
@@ -264,17 +309,17 @@ class SPKS_NeuronalData:
 
             burstevent = 0  # Electrode burst count #
 
-            while final_pos <= len(self.spiketimes[electrode]):  # Keeps the code from running into the arrays limit #
+            while final_pos <= len(train):  # Keeps the code from running into the arrays limit #
 
                 while spikecount < 4:
 
-                    if final_pos >= len(self.spiketimes[electrode]) - 1:  # Prevents eternal loop #
+                    if final_pos >= len(train) - 1:  # Prevents eternal loop #
 
                         break
 
                     # This is the difference being computed (is it less than 100ms for four spikes?) #
 
-                    time_difference = self.spiketimes[electrode][final_pos] - self.spiketimes[electrode][initial_pos]
+                    time_difference = train[final_pos] - train[initial_pos]
 
                     if time_difference <= 100:
 
@@ -291,23 +336,23 @@ class SPKS_NeuronalData:
 
                 while time_difference <= 100:
 
-                    if final_pos >= len(self.spiketimes[electrode]) - 1:
+                    if final_pos >= len(train) - 1:
 
                         break
 
                     spikecount = spikecount + 1
                     final_pos = final_pos + 1
-                    time_difference = self.spiketimes[electrode][final_pos] - self.spiketimes[electrode][initial_pos]
+                    time_difference = train[final_pos] - train[initial_pos]
 
-                if final_pos >= len(self.spiketimes[electrode]) - 1:  # Last save when reaches limit #
+                if final_pos >= len(train) - 1:  # Last save when reaches limit #
 
                     break
 
                 # Accounting for interburst interval (IBI) of 50 ms #
 
-                if self.spiketimes[electrode][final_pos + 1] - self.spiketimes[electrode][final_pos] >= 50:
+                if train[final_pos + 1] - train[final_pos] >= 50:
 
-                    overallIBI[electrode].append(self.spiketimes[electrode][final_pos + 1] - self.spiketimes[electrode][final_pos])
+                    overallIBI[electrode].append(train[final_pos + 1] - train[final_pos])
                     burstcount = burstcount + 1
                     burstprofile[electrode][burstevent] = list()
                     burstduration[electrode][burstevent] = spikecount
@@ -316,7 +361,7 @@ class SPKS_NeuronalData:
 
                     for n in range(0, spikecount):
 
-                        burstprofile[electrode][burstevent].append(str(self.spiketimes[electrode][final_pos - n]))
+                        burstprofile[electrode][burstevent].append(str(train[final_pos - n]))
 
                     burstevent = burstevent + 1  # Moves to the next burst occurrence
 
@@ -364,11 +409,9 @@ class SPKS_NeuronalData:
 
         overallIBI = list()
 
-        for electrode in self.spiketimes.keys():  # Computing it for all channels #
+        for electrode in self.trains:  # Computing it for all channels #
 
-            if electrode == 'duration':  # First position on the spiketimes dictionary is the duration of recording #
-
-                continue
+            train = self.trains[electrode]  # Zero-copy view of the spike times of the electrode #
 
             print('Channel analysed: ', electrode)
             burstprofile[electrode] = dict()
@@ -376,17 +419,17 @@ class SPKS_NeuronalData:
 
             burstevent = 0  # Electrode burst count #
 
-            while final_pos <= len(self.spiketimes[electrode]):  # Keeps the code from running into the arrays limit #
+            while final_pos <= len(train):  # Keeps the code from running into the arrays limit #
 
                 while spikecount < 4:
 
-                    if final_pos >= len(self.spiketimes[electrode]) - 1:  # Prevents eternal loop #
+                    if final_pos >= len(train) - 1:  # Prevents eternal loop #
 
                         break
 
                     # This is the difference being computed (is it less than 100ms for four spikes?) #
 
-                    time_difference = self.spiketimes[electrode][final_pos] - self.spiketimes[electrode][initial_pos]
+                    time_difference = train[final_pos] - train[initial_pos]
 
                     if time_difference <= 500:
 
@@ -403,21 +446,21 @@ class SPKS_NeuronalData:
 
                 while time_difference <= 500:
 
-                    if final_pos >= len(self.spiketimes[electrode]) - 1:
+                    if final_pos >= len(train) - 1:
 
                         break
 
                     spikecount = spikecount + 1
                     final_pos = final_pos + 1
-                    time_difference = self.spiketimes[electrode][final_pos] - self.spiketimes[electrode][initial_pos]
+                    time_difference = train[final_pos] - train[initial_pos]
 
-                if final_pos >= len(self.spiketimes[electrode]) - 1:  # Last save when reaches limit #
+                if final_pos >= len(train) - 1:  # Last save when reaches limit #
 
                     break
 
-                if self.spiketimes[electrode][final_pos + 1] - self.spiketimes[electrode][final_pos] <= 50:
+                if train[final_pos + 1] - train[final_pos] <= 50:
 
-                    overallIBI.append(self.spiketimes[electrode][final_pos + 1] - self.spiketimes[electrode][final_pos])
+                    overallIBI.append(train[final_pos + 1] - train[final_pos])
                     burstcount = burstcount + 1
                     burstprofile[electrode][burstevent] = list()
                     burstduration[electrode][burstevent] = spikecount
@@ -426,7 +469,7 @@ class SPKS_NeuronalData:
 
                     for n in range(0, spikecount):
 
-                        burstprofile[electrode][burstevent].append(str(self.spiketimes[electrode][final_pos - n]))
+                        burstprofile[electrode][burstevent].append(str(train[final_pos - n]))
 
                     burstevent = burstevent + 1  # Moves to the next burst occurrence
 
@@ -459,9 +502,7 @@ class SPKS_NeuronalData:
 
     def active_electrodes(self):
 
-        # Data has to come from RAW_NeuronalData. If MATLAB, subtract one instead.
-
-        active = len(self.spiketimes.keys()) - 1  # Removes the dictionary entry called 'duration'.
+        active = len(self.trains)  # Electrodes with spike trains #
 
         return active
 
@@ -475,36 +516,24 @@ class SPKS_NeuronalData:
 
         bin_count = int(bin_count)
 
-        binned_channels = {}  # Dictionary that will store the binned arrays
-
-        for keys in self.spiketimes.keys():
-
-            if keys != 'duration':
-
-                binned_channels[keys] = np.empty(bin_count)  # Adds zero to each position of the binned array
-
-                for bin_comparison in range(1, bin_count):
-
-                    binned_channels[keys][bin_comparison] = 0
+        # Bin number n counts the spikes with (n - 1) * 2500 < spike time < n * 2500 (binning per 100ms, sampling rate
+        # of 25000/sec). Spikes falling exactly on a bin edge are not counted. #
 
-                for binning in range(0, len(self.spiketimes[keys])):
+        times = self.trains.times
+        bins = np.floor(times / 2500).astype(int) + 1
+        counted = (bins >= 1) & (bins < bin_count) & (np.mod(times, 2500) != 0)
 
-                    for bin_comparison in range(1, bin_count):
+        flat_bins = self.trains.spike_electrodes()[counted] * bin_count + bins[counted]
+        binned = np.bincount(flat_bins, minlength=len(self.trains) * bin_count).astype(float)
+        binned = binned.reshape(len(self.trains), bin_count)
 
-                        current_bin = bin_comparison * 2500  # Binning per 100ms, sampling rate of 25000/sec
-                        last_bin = current_bin - 2500
-
-                        if last_bin < self.spiketimes[keys][binning] < current_bin:
-
-                            binned_channels[keys][bin_comparison] = binned_channels[keys][bin_comparison] + 1
-
-        return binned_channels
+        return dict(zip(self.trains.electrodes, binned))  # Dictionary that will store the binned arrays
 
     def get_bin_number(self):
 
         # Each bin has one second
 
-        duration_ms = self.spiketimes['duration']
+        duration_ms = self.trains.duration
         bins = duration_ms / 2500
 
         return bins
@@ -528,13 +557,7 @@ class SPKS_NeuronalData:
 
         dict_xcov_peak_and_threshold_eachpair = dict()
 
-        electrodes = list()
-
-        for keys in self.spiketimes.keys():
-
-            if keys != 'duration':
-
-                electrodes.append(keys)  # Acquiring all the active electrodes
+        electrodes = list(self.trains.electrodes)  # Acquiring all the active electrodes
 
         for xcov in range(0, len(electrodes)):
 
@@ -653,38 +676,13 @@ class SPKS_NeuronalData:
         grid_plot = plt.figure(dpi=300)
         plotnumber = 1
 
-        intervals = dict()
-        overallISI = list()
-
-        initial_position = 0
-        final_position = 1
-
         print('Performing the ISI histogram analysis')
 
-        for electrode in self.spiketimes.keys():
+        # ISIs of all electrodes at once, with a view of the ISIs of each electrode #
 
-            if electrode == 'duration':  # First position on the spiketimes dictionary is the duration of recording #
+        overallISI, intervals = self.trains.intervals()
 
-                continue
-
-            if electrode == 'mock_spiketimes':  # First position on the spiketimes dictionary is the duration of recording #
-
-                continue
-
-            intervals[electrode] = list()  # Each list stores the ISIs of a given electrode
-
-            while final_position < len(self.spiketimes[electrode]):  # Keeps the code into the arrays limit #
-
-                ISI = self.spiketimes[electrode][final_position] - self.spiketimes[electrode][initial_position]
-
-                intervals[electrode].append(ISI)
-                overallISI.append(ISI)
-
-                final_position = final_position + 1
-                initial_position = initial_position + 1
-
-            initial_position = 0
-            final_position = 1
+        for electrode in self.trains:
 
             if len(intervals[electrode]) == 0:
 
@@ -708,9 +706,7 @@ class SPKS_NeuronalData:
 
         MEAplot = plt.figure(dpi=500)
 
-        mea_ISI = list()
-        mea_ISI = overallISI
-        overallISI = np.array(overallISI)
+        mea_ISI = overallISI.tolist()
         averageISI = overallISI.mean()
 
         sns.set_context("paper")
@@ -758,21 +754,9 @@ class SPKS_NeuronalData:
         fig = plt.figure(dpi=500)
         ax1 = fig.add_subplot(111)
 
-        list_of_lists = list()
-
-        for channel in self.spiketimes.keys():
-
-            if channel == 'duration':
-
-                continue
-
-            list_of_lists.append(self.spiketimes[channel])
-
-            #plt.plot(self.spiketimes[channel], np.repeat(int(channel), len(self.spiketimes[channel])), marker=2,
-            #         label=channel)
+        list_of_lists = [self.trains[channel] for channel in self.trains]  # Zero-copy views of the spike trains #
 
-        array_of_lists=np.array(list_of_lists)
-        ax1.eventplot(positions=array_of_lists, linelengths=0.5)
+        ax1.eventplot(positions=list_of_lists, linelengths=0.5)
         plt.title(MEA)
         #plt.legend(fontsize=4, loc='upper left')
         plt.ticklabel_format(axis="x", style="sci", scilimits=(0,0))
@@ -787,6 +771,233 @@ class SPKS_NeuronalData:
 
 # ----------------------------------------------------------------------------------------------------------------- #
 
+# Spike train container #
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+
+SpikeTrainHeader = namedtuple('SpikeTrainHeader', ['duration', 'fs'])  # Record duration (samples) and sampling rate (Hz)
+
+
+class SpikeTrains:
+
+    """ Compact, CSR-style container of the spike trains of a MEA: the sorted spike times of all electrodes
+    concatenated in one array, plus an offsets array so that the spikes of electrode number i are
+    times[offsets[i]:offsets[i + 1]]. Indexing with an electrode number returns a zero-copy view, and analyses can run
+    over all electrodes at once on the concatenated array.
+    """
+
+    def __init__(self, electrodes, times, offsets, header):
+
+        """ Arguments:
+
+                electrodes(list): Electrode numbers, in storage order
+                times(array): Concatenated spike times in ms, sorted within each electrode
+                offsets(array): Position of the first spike of each electrode, plus the total spike number at the end
+                header(SpikeTrainHeader): Record duration in samples and sampling rate in Hz
+            """
+
+        self.electrodes = list(electrodes)
+        self.times = np.asarray(times, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.header = header
+        self.index = {electrode: position for position, electrode in enumerate(self.electrodes)}
+
+    @classmethod
+    def from_dict(cls, spiketimes, duration, fs=25000):
+
+        """ Packs a dictionary of spike times per electrode into a SpikeTrains container
+
+            Arguments:
+
+                spiketimes(dict): Dictionary with electrode numbers as keys and spike times in ms as values
+                duration(int): Record duration in samples
+                fs(int): Sampling rate in Hz
+
+            Returns:
+
+               SpikeTrains object
+            """
+
+        electrodes = list(spiketimes.keys())
+        trains = [np.asarray(spiketimes[electrode], dtype=float).ravel() for electrode in electrodes]
+        trains = [train if np.all(train[1:] >= train[:-1]) else np.sort(train, kind='stable') for train in trains]
+
+        offsets = np.zeros(len(trains) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(train) for train in trains])
+        times = np.concatenate(trains) if trains else np.zeros(0)
+
+        return cls(electrodes=electrodes, times=times, offsets=offsets, header=SpikeTrainHeader(duration, fs))
+
+    @property
+    def duration(self):
+
+        return self.header.duration
+
+    @property
+    def fs(self):
+
+        return self.header.fs
+
+    def __len__(self):
+
+        return len(self.electrodes)
+
+    def __iter__(self):
+
+        return iter(self.electrodes)
+
+    def __contains__(self, electrode):
+
+        return electrode in self.index
+
+    def __getitem__(self, electrode):
+
+        position = self.index[electrode]
+
+        return self.times[self.offsets[position]:self.offsets[position + 1]]
+
+    def counts(self):
+
+        """ Number of spikes of each electrode, in storage order """
+
+        return np.diff(self.offsets)
+
+    def spike_electrodes(self):
+
+        """ Position (in storage order) of the electrode of every spike in the concatenated times array """
+
+        return np.repeat(np.arange(len(self.electrodes)), self.counts())
+
+    def intervals(self):
+
+        """ Computes the inter-spike intervals of all electrodes in one operation
+
+            Returns:
+
+               Concatenated ISIs of all electrodes, and a dictionary with a zero-copy view of the ISIs of each electrode
+            """
+
+        differences = np.diff(self.times)
+        within = np.ones(len(differences), dtype=bool)
+
+        # Drops the differences between the last spike of an electrode and the first spike of the next one #
+
+        boundaries = self.offsets[1:-1] - 1
+        within[boundaries[(boundaries >= 0) & (boundaries < len(differences))]] = False
+
+        ISIs = differences[within]
+        ISI_offsets = np.zeros(len(self.offsets), dtype=np.int64)
+        ISI_offsets[1:] = np.cumsum(np.maximum(self.counts() - 1, 0))
+
+        per_electrode = {electrode: ISIs[ISI_offsets[position]:ISI_offsets[position + 1]]
+                         for position, electrode in enumerate(self.electrodes)}
+
+        return ISIs, per_electrode
+
+    def drop(self, electrodes):
+
+        """ Returns a SpikeTrains container without some electrodes
+
+            Arguments:
+
+                electrodes(list): Electrode numbers to be removed
+
+            Returns:
+
+               SpikeTrains object
+            """
+
+        kept = [electrode for electrode in self.electrodes if electrode not in electrodes]
+        kept_positions = [self.index[electrode] for electrode in kept]
+
+        spikes = np.zeros(len(self.times), dtype=bool)
+
+        for position in kept_positions:
+
+            spikes[self.offsets[position]:self.offsets[position + 1]] = True
+
+        offsets = np.zeros(len(kept) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(self.counts()[kept_positions])
+
+        return SpikeTrains(electrodes=kept, times=self.times[spikes], offsets=offsets, header=self.header)
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+# Functions for data import #
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+
+def batch_MATLAB_import(recordings, exclude=None, workers=4):
+
+    """ Imports the spike trains exported with MCD_files_export_uV_mS_metadata_and_spikes.m (*_spiketimes_ms.mat and
+    *_spikevalues_uV.mat) of many MEAs at once, reading several MEAs concurrently
+
+        Arguments:
+
+            recordings(dict): Dictionary with MEA numbers as keys and the folder of each recording (ending with the
+            path separator) as values
+            exclude(dict): Dictionary with MEA numbers as keys and the electrodes to leave out as values
+            workers(int): Number of MEAs read at the same time
+
+        Returns:
+
+           Dictionary with MEA numbers as keys and SPKS_NeuronalData objects as values. MEAs without exported spikes
+           are skipped.
+        """
+
+    if exclude is None:
+
+        exclude = dict()
+
+    def import_MEA(MEA):
+
+        folder = recordings[MEA]
+
+        return SPKS_NeuronalData(input='MATLAB', occurrence_ms=folder + MEA + '_spiketimes_ms.mat',
+                                 shapedata=folder + MEA + '_spikevalues_uV.mat',
+                                 time_array=folder + MEA + '_time_array_ms.mat',
+                                 channelids=folder + MEA + '_correct_electrode_order.mat', exclude=exclude.get(MEA))
+
+    MEAs = [MEA for MEA in recordings if os.path.exists(recordings[MEA] + MEA + '_spikevalues_uV.mat')]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        imported = executor.map(import_MEA, MEAs)
+
+        return dict(zip(MEAs, imported))
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+# Functions for channel selection #
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
+
+def channel_selected(key, channels=None, exclude=None):
+
+    """ Checks if an electrode passes an include list and an exclude list (electrode numbers as int or str)
+
+        Arguments:
+
+            key(str): Electrode number
+            channels(list): Electrodes to be kept, all electrodes if None
+            exclude(list): Electrodes to be left out
+
+        Returns:
+
+           True if the electrode should be loaded
+        """
+
+    if channels is not None and str(key) not in [str(channel) for channel in channels]:
+
+        return False
+
+    return exclude is None or str(key) not in [str(channel) for channel in exclude]
+
+# ----------------------------------------------------------------------------------------------------------------- #
+
 # Functions for CN analysis #
 
 # ----------------------------------------------------------------------------------------------------------------- #
@@ -920,6 +1131,134 @@ def DIV_ISI_histogram(filename, DIV, figpath, ISIlist):
 # ----------------------------------------------------------------------------------------------------------------- #
 
 
+SPIKE_DATA_FORMAT_VERSION = 1
+
+
+def write_spike_data(spike_data, path, thresholds=None, metadata=None):
+
+    """ Writes the spike times, waveforms and detection thresholds of a SPKS_NeuronalData object to a HDF5 file that
+    can be read back partially (single electrodes, or spike times without waveforms) with
+    SPKS_NeuronalData(input="HDF5", ...). Layout of format version 1:
+
+        attributes: format_version, duration (samples), fs (Hz) and any metadata
+        electrodes: Electrode numbers (str), in storage order
+        spiketimes: Spike times in ms of all electrodes concatenated, sorted within each electrode
+        offsets: First spike of each electrode in spiketimes, plus the total spike number at the end
+        waveforms: (spikes x samples) float32 waveforms of all electrodes concatenated (optional)
+        waveform_offsets: First waveform of each electrode in waveforms, plus the total at the end (optional)
+        thresholds/<electrode>: Thresholds of each detection round in uV (optional)
+
+        Arguments:
+
+            spike_data(SPKS_NeuronalData): Spike trains to be written
+            path(str): Full path of the output file
+            thresholds(dict): Dictionary with electrode numbers as keys and the thresholds of each round as values
+            metadata(dict): Attributes to be saved with the data (e.g. MEA number)
+
+        Returns:
+
+           Output file
+        """
+
+    trains = spike_data.trains
+
+    with h5py.File(path, 'w') as file:
+
+        file.attrs['format_version'] = SPIKE_DATA_FORMAT_VERSION
+        file.attrs['duration'] = trains.duration
+        file.attrs['fs'] = trains.fs
+
+        for key, value in (metadata or {}).items():
+
+            file.attrs[key] = value
+
+        file.create_dataset('electrodes', data=[str(electrode) for electrode in trains.electrodes],
+                            dtype=h5py.string_dtype())
+        file.create_dataset('offsets', data=trains.offsets)
+        file.create_dataset('spiketimes', data=trains.times, chunks=(min(max(len(trains.times), 1), 65536),),
+                            maxshape=(None,), compression='gzip', shuffle=True)  # Unlimited, so 0 spikes can chunk #
+
+        waveforms = [waveform_matrix(spike_data.spikeshapes.get(electrode)) for electrode in trains.electrodes]
+        widths = set(waveform.shape[1] for waveform in waveforms if len(waveform))
+
+        if len(widths) <= 1:
+
+            width = widths.pop() if widths else 75
+            waveforms = [waveform if len(waveform) else np.zeros((0, width), dtype=np.float32)
+                         for waveform in waveforms]
+
+            waveform_offsets = np.zeros(len(waveforms) + 1, dtype=np.int64)
+            waveform_offsets[1:] = np.cumsum([len(waveform) for waveform in waveforms])
+
+            stacked = np.concatenate(waveforms) if waveforms else np.zeros((0, width), dtype=np.float32)
+
+            file.create_dataset('waveform_offsets', data=waveform_offsets)
+            file.create_dataset('waveforms', data=stacked, chunks=(min(max(len(stacked), 1), 4096), width),
+                                maxshape=(None, width), compression='gzip', shuffle=True)
+
+        if thresholds is not None:
+
+            group = file.create_group('thresholds')
+
+            for electrode in thresholds:
+
+                group.create_dataset(str(electrode), data=np.asarray(thresholds[electrode], dtype=float))
+
+
+def read_thresholds(path, electrodes=None):
+
+    """ Reads the detection thresholds saved by write_spike_data
+
+        Arguments:
+
+            path(str): Full path of the spike data file
+            electrodes(list): Electrode numbers to be read, all electrodes if None
+
+        Returns:
+
+           Dictionary with electrode numbers as keys and the thresholds of each round as values
+        """
+
+    with h5py.File(path, 'r') as file:
+
+        check_spike_data_version(file)
+
+        if 'thresholds' not in file:
+
+            return dict()
+
+        return {electrode: file['thresholds'][electrode][()] for electrode in file['thresholds']
+                if electrodes is None or electrode in [str(key) for key in electrodes]}
+
+
+def check_spike_data_version(file):
+
+    version = file.attrs.get('format_version')
+
+    if version is None or version > SPIKE_DATA_FORMAT_VERSION:
+
+        raise ValueError("Spike data file " + str(file.filename) + " has format version " + str(version) +
+                         ", this code reads versions up to " + str(SPIKE_DATA_FORMAT_VERSION))
+
+
+def waveform_matrix(shapes):
+
+    """ Stacks the waveforms of one electrode (array, dictionary of arrays per occurrence, or None) into a contiguous
+    float32 (spikes x samples) matrix """
+
+    if shapes is None:
+
+        return np.zeros((0, 0), dtype=np.float32)
+
+    if isinstance(shapes, dict):
+
+        shapes = [shapes[occurrence] for occurrence in sorted(shapes)]
+
+    shapes = np.ascontiguousarray(shapes, dtype=np.float32)
+
+    return shapes.reshape(len(shapes), -1) if shapes.size else np.zeros((0, 0), dtype=np.float32)
+
+
 def write_FRs(MEA, FR, filename, output_path):
 
     fullname = output_path + filename + ".txt"
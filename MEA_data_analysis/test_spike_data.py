@@ -0,0 +1,37 @@
+from class_SPKS_NeuronalData import *
+import numpy as np
+
+
+def spike_data_file(path):
+
+    """ Writes a spike data file with electrodes 24 and 25, five spikes each """
+
+    spiketimes = {'24': [1.0, 2.0, 3.0, 4.0, 5.0], '25': [1.5, 2.5, 3.5, 4.5, 5.5]}
+    spikeshapes = {key: np.ones((5, 75), dtype=np.float32) for key in spiketimes}
+
+    spike_data = SPKS_NeuronalData(input="RAWdata", occurrence_ms=spiketimes, shapedata=spikeshapes, duration=1000)
+    write_spike_data(spike_data=spike_data, path=path)
+
+    return path
+
+
+def test_exclusion_without_shapes(tmp_path):
+
+    spike_data = SPKS_NeuronalData(input="HDF5", occurrence_ms=spike_data_file(str(tmp_path / 'MEA_spikes.h5')),
+                                   shapedata=False)
+
+    spike_data.exclusion(['24'])
+
+    assert spike_data.trains.electrodes == ['25']
+    assert spike_data.spikeshapes == {}
+
+
+def test_exclusion_with_shapes(tmp_path):
+
+    spike_data = SPKS_NeuronalData(input="HDF5", occurrence_ms=spike_data_file(str(tmp_path / 'MEA_spikes.h5')),
+                                   shapedata=True)
+
+    spike_data.exclusion([24])
+
+    assert spike_data.trains.electrodes == ['25']
+    assert list(spike_data.spikeshapes) == ['25']